@@ -0,0 +1,378 @@
+"""Offline benchmarks for the bot's hot paths: no Telegram or Cloudflare account needed.
+
+    python bench.py                          # every scenario, results in bench_output.txt
+    python bench.py -s tg_upload range_seek --latency-ms 80 --conn-mbps 40
+    python bench.py --baseline last.jsonl    # exit 1 if anything regressed past --tolerance
+
+Telegram is replaced by a fake client with per-request latency and bandwidth (both
+GetFile for tg_download and Save(Big)FilePart for fast_upload); R2 by a local
+S3-compatible HTTP stub driven through the real boto3 client, pre-filled with a
+synthetic bucket. Each result is one JSON line: scenario, metric, value, unit, better.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+import itertools
+import bisect
+import base64
+import datetime
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WORKDIR = tempfile.mkdtemp(prefix='tgbot-bench-')
+
+# main.py reads its config at import time; keep its session and databases out of the repo
+os.environ.update(API_ID='1', API_HASH='bench', BOT_TOKEN='bench', R2_ACCOUNT_ID='bench',
+                  R2_ACCESS_KEY_ID='bench', R2_SECRET_ACCESS_KEY='bench', R2_BUCKET_NAME='bench',
+                  R2_PUBLIC_URL='https://r2.invalid', LINK_DB_PATH='', DEDUP_DB_PATH='',
+                  DASHBOARD_USER='bench', DASHBOARD_PASS='bench')
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+import boto3
+from botocore.config import Config
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from telethon.tl.functions.upload import GetFileRequest
+import main
+
+MB = 1024 * 1024
+PATTERN = random.Random(0).randbytes(main.TG_CHUNK_SIZE)
+
+# --- FAKE TELEGRAM ---
+class FakeLink:
+    """Per-request RTT plus a per-connection cap and one shared bottleneck, like a real uplink."""
+    def __init__(self, latency, conn_bps, link_bps):
+        self.latency, self.conn_bps, self.link_bps = latency, conn_bps, link_bps
+        self.free_at = 0
+
+    async def transfer(self, nbytes):
+        now = time.monotonic()
+        self.free_at = max(self.free_at, now) + nbytes / self.link_bps
+        await asyncio.sleep(max(self.latency + nbytes / self.conn_bps, self.free_at - now))
+
+class FakeTelegram:
+    def __init__(self, link, files):
+        self.link, self.files = link, files
+        self.requests = 0
+
+    async def call(self, sender, request):
+        # Stands in for TelegramClient._call, which tg_download drives directly
+        assert isinstance(request, GetFileRequest)
+        self.requests += 1
+        n = max(min(request.limit, self.files[request.location.id] - request.offset), 0)
+        await self.link.transfer(n)
+        return SimpleNamespace(bytes=PATTERN[:n])
+
+    async def __call__(self, request, flood_sleep_threshold=None):
+        # fast_upload's SaveFilePartRequest / SaveBigFilePartRequest
+        self.requests += 1
+        await self.link.transfer(len(request.bytes))
+        return True
+
+    async def senders(self, dc_id):
+        return [object() for _ in range(max(main.TG_DOWNLOAD_SENDERS, 1))]
+
+class FakeMessage:
+    async def edit(self, *args, **kwargs): pass
+
+def tg_record(code_id, size):
+    return {'kind': 'doc', 'id': code_id, 'access_hash': 0, 'file_reference': '', 'thumb_size': '',
+            'dc_id': 2, 'size': size, 'mime': 'video/mp4', 'name': 'bench.mp4', 'chat_id': 0, 'msg_id': 0}
+
+# --- LOCAL S3 STUB ---
+class S3Stub:
+    """Just enough of the S3 REST API for the calls main.py makes. Object bodies are
+    counted, not kept, so a 100k-object bucket costs a few MB of RAM."""
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.keys = sorted(self.objects)
+        self.uploads, self.upload_ids = {}, itertools.count(1)
+        self.received = 0
+
+    def _index_add(self, key, size):
+        if key not in self.objects: bisect.insort(self.keys, key)
+        self.objects[key] = (size, time.time())
+
+    async def _drain(self, request):
+        n = 0
+        async for chunk in request.content.iter_any(): n += len(chunk)
+        # botocore may send aws-chunked bodies; the decoded length is what was uploaded
+        n = int(request.headers.get('x-amz-decoded-content-length', n))
+        self.received += n
+        return n
+
+    async def handle(self, request):
+        q = request.query
+        key = request.match_info.get('key', '')
+        if request.method == 'GET' and not key:
+            return self.list_uploads() if 'uploads' in q else self.list_objects(q)
+        if request.method == 'GET' and 'uploadId' in q:
+            if q['uploadId'] not in self.uploads: return self.no_such_upload()
+            parts = self.uploads[q['uploadId']][1]
+            return self.xml('ListPartsResult', f'<Bucket>bench</Bucket><Key>{key}</Key><UploadId>{q["uploadId"]}</UploadId><IsTruncated>false</IsTruncated>' + ''.join(
+                f'<Part><PartNumber>{n}</PartNumber><ETag>"{size:x}"</ETag><Size>{size}</Size></Part>' for n, size in sorted(parts.items())))
+        if request.method == 'PUT':
+            n = await self._drain(request)
+            if 'uploadId' in q and q['uploadId'] not in self.uploads: return self.no_such_upload()
+            if 'uploadId' in q:
+                self.uploads[q['uploadId']][1][int(q['partNumber'])] = n
+            else:
+                self._index_add(key, n)
+            return web.Response(headers={'ETag': f'"{n:x}"'})
+        if request.method == 'POST' and 'uploads' in q:
+            upload_id = str(next(self.upload_ids))
+            self.uploads[upload_id] = (key, {})
+            return self.xml('InitiateMultipartUploadResult', f'<Bucket>bench</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>')
+        if request.method == 'POST' and 'uploadId' in q:
+            await request.read()
+            key, parts = self.uploads.pop(q['uploadId'])
+            self._index_add(key, sum(parts.values()))
+            return self.xml('CompleteMultipartUploadResult', f'<Key>{key}</Key><ETag>"done"</ETag>')
+        if request.method == 'DELETE':
+            if 'uploadId' in q: self.uploads.pop(q['uploadId'], None)
+            elif self.objects.pop(key, None): self.keys.remove(key)
+            return web.Response(status=204)
+        if key in self.objects:
+            size = self.objects[key][0]
+            return web.Response(body=b'' if request.method == 'HEAD' else PATTERN[:size], headers={'Content-Length': str(size), 'ETag': '"x"'})
+        return web.Response(status=404)
+
+    def list_objects(self, q):
+        prefix, limit = q.get('prefix', ''), min(int(q.get('max-keys', 1000)), 1000)
+        start = bisect.bisect_right(self.keys, q['continuation-token']) if 'continuation-token' in q else bisect.bisect_left(self.keys, prefix)
+        page = list(itertools.takewhile(lambda k: k.startswith(prefix), itertools.islice(self.keys, start, start + limit + 1)))
+        truncated = len(page) > limit
+        page = page[:limit]
+        body = ''.join(
+            f'<Contents><Key>{k}</Key><LastModified>{datetime.datetime.fromtimestamp(self.objects[k][1], datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")}</LastModified>'
+            f'<ETag>"x"</ETag><Size>{self.objects[k][0]}</Size><StorageClass>STANDARD</StorageClass></Contents>' for k in page)
+        body += f'<Name>bench</Name><Prefix>{prefix}</Prefix><KeyCount>{len(page)}</KeyCount><MaxKeys>{limit}</MaxKeys><IsTruncated>{str(truncated).lower()}</IsTruncated>'
+        if truncated: body += f'<NextContinuationToken>{page[-1]}</NextContinuationToken>'
+        return self.xml('ListBucketResult', body)
+
+    def no_such_upload(self):
+        return web.Response(status=404, content_type='application/xml',
+                            text='<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchUpload</Code><Message>gone</Message></Error>')
+
+    def list_uploads(self):
+        return self.xml('ListMultipartUploadsResult', '<Bucket>bench</Bucket><IsTruncated>false</IsTruncated>' + ''.join(
+            f'<Upload><Key>{key}</Key><UploadId>{upload_id}</UploadId><Initiated>2020-01-01T00:00:00.000Z</Initiated></Upload>'
+            for upload_id, (key, _) in self.uploads.items()))
+
+    def xml(self, root, inner, status=200):
+        return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?><{root} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">{inner}</{root}>',
+                            content_type='application/xml', status=status)
+
+def start_s3_stub(stub):
+    """Serves the stub from its own thread and loop, like a remote endpoint would be."""
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route('*', '/bench', stub.handle)
+        app.router.add_route('*', '/bench/{key:.+}', stub.handle)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        holder['port'] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{holder['port']}"
+
+def synthetic_bucket(n):
+    rng = random.Random(1)
+    folders = [f"{y}/{m}/{d}" for y in (2024, 2025) for m in range(1, 13) for d in (1, 10, 20)]
+    now = time.time()
+    return {f"{rng.choice(folders)}/video_{i:06d}.mp4": (rng.randint(MB, 4096 * MB), now - rng.randint(0, 86400 * 700)) for i in range(n)}
+
+# --- HELPERS ---
+def pct(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0
+
+def rss_peak_sampler():
+    state = {'peak': main.get_rss_bytes(), 'stop': False}
+    async def sample():
+        while not state['stop']:
+            state['peak'] = max(state['peak'], main.get_rss_bytes())
+            await asyncio.sleep(0.01)
+    return state, asyncio.create_task(sample())
+
+def auth_headers():
+    token = base64.b64encode(f"{main.DASHBOARD_USER}:{main.DASHBOARD_PASS}".encode()).decode()
+    return {'Authorization': f'Basic {token}'}
+
+class Bench:
+    def __init__(self, args):
+        self.args, self.results = args, []
+        self.tg = FakeTelegram(FakeLink(args.latency_ms / 1000, args.conn_mbps * MB / 8, args.link_mbps * MB / 8), {})
+        main.client._call = self.tg.call
+        main.get_tg_senders = self.tg.senders
+        self.s3 = S3Stub(synthetic_bucket(args.objects))
+        endpoint = start_s3_stub(self.s3)
+        main.r2_client = boto3.client('s3', endpoint_url=endpoint, aws_access_key_id='bench', aws_secret_access_key='bench',
+                                      config=Config(region_name='auto', signature_version='s3v4', max_pool_connections=main.R2_MAX_POOL,
+                                                    s3={'addressing_style': 'path'}))
+        main.r2_client.meta.events.register('before-call.s3', main.r2_call_started)
+        main.r2_client.meta.events.register('after-call.s3', main.r2_call_finished)
+        self.size = args.size_mb * MB
+        self.file_path = os.path.join(WORKDIR, 'bench.bin')
+        with open(self.file_path, 'wb') as f:
+            for _ in range(args.size_mb): f.write(PATTERN[:MB])
+        self.tg.files[1] = self.size
+        self.code = main.link_store.put(tg_record(1, self.size))
+
+    def record(self, scenario, metric, value, unit, better):
+        row = {'scenario': scenario, 'metric': metric, 'value': round(value, 4), 'unit': unit, 'better': better}
+        self.results.append(row)
+        print(json.dumps(row), flush=True)
+
+    async def app_client(self):
+        app = web.Application(middlewares=[main.metrics_middleware])
+        app.add_routes(main.routes)
+        return TestClient(TestServer(app))
+
+    async def tg_upload(self):
+        t0 = time.monotonic()
+        await main.fast_upload(self.tg, self.file_path, FakeMessage(), 'bench.bin')
+        self.record('tg_upload', 'throughput', self.size / MB / (time.monotonic() - t0), 'MiB/s', 'higher')
+
+    async def r2_upload(self):
+        progress = main.Progress(None, 'bench', 'bench.bin', self.size)
+        t0 = time.monotonic()
+        await asyncio.to_thread(main.sync_r2_upload, self.file_path, 'bench/file.bin', progress)
+        self.record('r2_upload', 'throughput', self.size / MB / (time.monotonic() - t0), 'MiB/s', 'higher')
+
+        t0 = time.monotonic()
+        chunks = main.tg_download((2, main.tg_record_location(tg_record(1, self.size))[1]), self.size)
+        await main.stream_to_r2(chunks, 'bench/stream.bin', self.size, 'video/mp4', FakeMessage(), 'bench')
+        self.record('tg_to_r2_stream', 'throughput', self.size / MB / (time.monotonic() - t0), 'MiB/s', 'higher')
+
+    async def range_seek(self):
+        rng, ttfb = random.Random(2), []
+        async with await self.app_client() as http:
+            for _ in range(self.args.seeks):
+                start = rng.randrange(0, self.size - 256 * 1024)
+                t0 = time.monotonic()
+                async with http.get(f'/{self.code}/bench.mp4', headers={'Range': f'bytes={start}-'}) as r:
+                    assert r.status == 206
+                    await r.content.readany()
+                    ttfb.append(time.monotonic() - t0)
+        self.record('range_seek', 'ttfb_p50', pct(ttfb, 0.5) * 1000, 'ms', 'lower')
+        self.record('range_seek', 'ttfb_p95', pct(ttfb, 0.95) * 1000, 'ms', 'lower')
+
+    async def stream_fanout(self):
+        ttfb = []
+        async def one(http):
+            t0 = time.monotonic()
+            async with http.get(f'/{self.code}/bench.mp4') as r:
+                received = len(await r.content.readany())
+                ttfb.append(time.monotonic() - t0)
+                async for chunk in r.content.iter_any(): received += len(chunk)
+            return received
+        async with await self.app_client() as http:
+            t0 = time.monotonic()
+            total = sum(await asyncio.gather(*(one(http) for _ in range(self.args.fanout))))
+            elapsed = time.monotonic() - t0
+        self.record('stream_fanout', 'aggregate_throughput', total / MB / elapsed, 'MiB/s', 'higher')
+        self.record('stream_fanout', 'ttfb_p95', pct(ttfb, 0.95) * 1000, 'ms', 'lower')
+
+    async def dashboard(self):
+        t0 = time.monotonic()
+        await main.r2_index.ensure_fresh(force=True)
+        self.record('dashboard', 'index_refresh', (time.monotonic() - t0) * 1000, 'ms', 'lower')
+        async with await self.app_client() as http:
+            for metric, path in (('render_first_page', '/dashboard'), ('render_search', '/dashboard?q=video_0999&sort=name'),
+                                 ('api_page', '/api/files?offset=5000&limit=200&sort=size')):
+                samples = []
+                for _ in range(self.args.repeat):
+                    t0 = time.monotonic()
+                    async with http.get(path, headers=auth_headers()) as r:
+                        assert r.status == 200, r.status
+                        await r.read()
+                    samples.append(time.monotonic() - t0)
+                self.record('dashboard', metric, statistics.median(samples) * 1000, 'ms', 'lower')
+
+    async def memory_per_job(self):
+        jobs = self.args.jobs
+        await main.governor.trim('idle')
+        base = main.get_rss_bytes()
+        state, sampler = rss_peak_sampler()
+        await asyncio.gather(*(main.stream_to_r2(main.tg_download((2, main.tg_record_location(tg_record(1, self.size))[1]), self.size),
+                                                 f'bench/mem{i}.bin', self.size, 'video/mp4', FakeMessage(), 'bench') for i in range(jobs)))
+        state['stop'] = True
+        await sampler
+        self.record('memory_per_job', 'tg_to_r2_stream_peak_rss', (state['peak'] - base) / MB / jobs, 'MiB/job', 'lower')
+
+        await main.governor.trim('idle')
+        base = main.get_rss_bytes()
+        state, sampler = rss_peak_sampler()
+        await asyncio.gather(*(main.fast_upload(self.tg, self.file_path, FakeMessage(), 'bench.bin') for _ in range(jobs)))
+        state['stop'] = True
+        await sampler
+        self.record('memory_per_job', 'tg_upload_peak_rss', (state['peak'] - base) / MB / jobs, 'MiB/job', 'lower')
+
+SCENARIOS = ['tg_upload', 'r2_upload', 'range_seek', 'stream_fanout', 'dashboard', 'memory_per_job']
+
+def compare(results, baseline_path, tolerance):
+    baseline = {}
+    with open(baseline_path) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                baseline[(row['scenario'], row['metric'])] = row['value']
+    regressions = []
+    for row in results:
+        old = baseline.get((row['scenario'], row['metric']))
+        if not old: continue
+        change = (row['value'] - old) / old
+        if (row['better'] == 'higher' and change < -tolerance) or (row['better'] == 'lower' and change > tolerance):
+            regressions.append(f"{row['scenario']}.{row['metric']}: {old} -> {row['value']} {row['unit']} ({change:+.0%})")
+    return regressions
+
+async def run(args):
+    bench = Bench(args)
+    for name in args.scenarios:
+        await getattr(bench, name)()
+    return bench.results
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    p.add_argument('-s', '--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    p.add_argument('--size-mb', type=int, default=64, help='test file size')
+    p.add_argument('--latency-ms', type=float, default=50, help='fake Telegram round trip per request')
+    p.add_argument('--conn-mbps', type=float, default=80, help='fake Telegram bandwidth per request')
+    p.add_argument('--link-mbps', type=float, default=800, help='fake Telegram bandwidth shared by all requests')
+    p.add_argument('--objects', type=int, default=100_000, help='synthetic bucket size')
+    p.add_argument('--seeks', type=int, default=50)
+    p.add_argument('--fanout', type=int, default=16, help='concurrent streams')
+    p.add_argument('--jobs', type=int, default=4, help='concurrent jobs for memory_per_job')
+    p.add_argument('--repeat', type=int, default=5, help='samples per dashboard request')
+    p.add_argument('-o', '--output', default=os.path.join(ROOT, 'bench_output.txt'), help='JSON lines results')
+    p.add_argument('--baseline', help='earlier results file to compare against')
+    p.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.run(run(args))
+    with open(args.output, 'w') as f:
+        for row in results: f.write(json.dumps(row) + "\n")
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions: print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
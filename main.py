@@ -1,5 +1,6 @@
 import os
 import secrets
+import hashlib
 import asyncio
 import mimetypes
 import time
@@ -9,16 +10,32 @@ import random
 import io
 import base64
 import subprocess
+import shutil
 import datetime
 import gc
 import ctypes
+import mmap
+import json
+import html
+import sqlite3
+import threading
+import heapq
+import bisect
+import itertools
+import contextvars
+import sys
+import logging
+from contextlib import asynccontextmanager
+from collections import deque, OrderedDict
+from queue import SimpleQueue, Empty
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, unquote
 
 # Telegram Imports
-from telethon import TelegramClient, events, types, Button
-from telethon.network import ConnectionTcpFull
+from telethon import TelegramClient, events, types, Button, utils, errors
+from telethon.network import ConnectionTcpFull, MTProtoSender
 from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest, GetFileRequest
-from telethon.tl.types import InputFileBig, InputFile
+from telethon.tl.types import InputFileBig, InputFile, InputDocumentFileLocation, InputPhotoFileLocation
 
 # Web, Storage & Engine Imports
 from aiohttp import web, ClientSession, FormData
@@ -26,7 +43,7 @@ import aiohttp
 import boto3
 from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
-import yt_dlp
+import botocore.exceptions
 
 # ============================================
 # --- 1. SECURE CONFIGURATION (FROM KOYEB) ---
@@ -45,10 +62,123 @@ R2_PUBLIC_URL = os.environ.get("R2_PUBLIC_URL", "").strip().rstrip('/')
 
 DASHBOARD_USER = os.environ.get("DASHBOARD_USER", "admin").strip()
 DASHBOARD_PASS = os.environ.get("DASHBOARD_PASS", "admin123").strip()
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "").strip()
+
+# Disk cache of Telegram chunks for /{code}/{name} streams ("" = off); LRU-capped at TG_CACHE_MAX_MB
+TG_CACHE_DIR = os.environ.get("TG_CACHE_DIR", "").strip()
+TG_CACHE_MAX_BYTES = int(os.environ.get("TG_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Telegram -> R2 streaming (no temp file): parts are buffered in RAM only
+R2_STREAM_UPLOAD = os.environ.get("R2_STREAM_UPLOAD", "1").strip() == "1"
+R2_STREAM_PART_SIZE = int(os.environ.get("R2_STREAM_PART_MB", "8")) * 1024 * 1024
+R2_STREAM_WORKERS = int(os.environ.get("R2_STREAM_WORKERS", "3"))
+
+# Shared R2 client pool and managed (file) upload tuning
+R2_MAX_POOL = int(os.environ.get("R2_MAX_POOL", "32"))
+R2_MULTIPART_THRESHOLD = int(os.environ.get("R2_MULTIPART_THRESHOLD_MB", "16")) * 1024 * 1024
+R2_MULTIPART_CHUNK = int(os.environ.get("R2_MULTIPART_CHUNK_MB", "16")) * 1024 * 1024
+R2_MAX_CONCURRENCY = int(os.environ.get("R2_MAX_CONCURRENCY", "10"))
+
+# Dashboard object index: full-bucket listing cached in RAM
+R2_INDEX_REFRESH = int(os.environ.get("R2_INDEX_REFRESH_SEC", "300"))
+DASHBOARD_PAGE_SIZE = int(os.environ.get("DASHBOARD_PAGE_SIZE", "200"))
+DASHBOARD_BATCH_ROWS = 100
+BULK_CONCURRENCY = int(os.environ.get("BULK_CONCURRENCY", "16"))
+
+# Parallel Telegram downloads: chunks in flight per file / MTProto connections per DC
+TG_DOWNLOAD_WORKERS = int(os.environ.get("TG_DOWNLOAD_WORKERS", "8"))
+TG_DOWNLOAD_SENDERS = int(os.environ.get("TG_DOWNLOAD_SENDERS", "2"))
+TG_CHUNK_SIZE = 1048576
+
+# Telegram uploads: 512 KiB parts, in-flight window adapts between these bounds
+TG_UPLOAD_MIN_WORKERS = int(os.environ.get("TG_UPLOAD_MIN_WORKERS", "4"))
+TG_UPLOAD_MAX_WORKERS = int(os.environ.get("TG_UPLOAD_MAX_WORKERS", "24"))
+TG_UPLOAD_PART_RETRIES = 5
+
+# Progress messages: per-message edit interval and bot-wide edit budget
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL_SEC", "4"))
+PROGRESS_EDITS_PER_MIN = int(os.environ.get("PROGRESS_EDITS_PER_MIN", "20"))
+
+# Direct links: segmented download engine ("native" aiohttp ranges or "aria2" subprocess)
+DIRECT_ENGINE = os.environ.get("DIRECT_ENGINE", "native").strip().lower()
+DIRECT_CONNECTIONS = int(os.environ.get("DIRECT_CONNECTIONS", "8"))
+DIRECT_PIECE_SIZE = int(os.environ.get("DIRECT_PIECE_MB", "8")) * 1024 * 1024
+DIRECT_SEGMENT_MIN = 4 * 1024 * 1024
+
+# Downloads to disk go through a write-behind sink: bytes queued per file before readers wait, max bytes per write call
+FILE_SINK_BUFFER = int(os.environ.get("FILE_SINK_BUFFER_MB", "32")) * 1024 * 1024
+FILE_SINK_COALESCE = 8 * 1024 * 1024
+
+# yt-dlp runs in child processes; extract_info results are cached per URL
+YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", "2"))
+YTDLP_EXTRACT_TIMEOUT = int(os.environ.get("YTDLP_EXTRACT_TIMEOUT_SEC", "120"))
+YTDLP_DOWNLOAD_TIMEOUT = int(os.environ.get("YTDLP_DOWNLOAD_TIMEOUT_SEC", "7200"))
+YTDLP_CACHE_TTL = int(os.environ.get("YTDLP_CACHE_TTL_SEC", "1800"))
+YTDLP_FAILURE_TTL = int(os.environ.get("YTDLP_FAILURE_TTL_SEC", "60"))
+YTDLP_CACHE_SIZE = int(os.environ.get("YTDLP_CACHE_SIZE", "32"))
+DIRECT_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.mov', '.webm', '.m4v', '.ts', '.mp3', '.m4a', '.flac', '.zip',
+                     '.rar', '.7z', '.tar', '.gz', '.iso', '.apk', '.exe', '.pdf', '.bin', '.img', '.srt'}
+
+# Direct link store: expiry, size cap and optional SQLite file ("" = RAM only)
+LINK_TTL = int(os.environ.get("LINK_TTL_HOURS", "24")) * 3600
+LINK_MAX_ENTRIES = int(os.environ.get("LINK_MAX_ENTRIES", "5000"))
+LINK_DB_PATH = os.environ.get("LINK_DB_PATH", "links.db").strip()
+# "Delete from R2" button references (one per object, kept in the SQLite file above)
+R2_REF_MAX_ENTRIES = int(os.environ.get("R2_REF_MAX_ENTRIES", "20000"))
+
+# Multi-process streaming: STREAM_WORKERS extra processes share the public PORT (SO_REUSEPORT),
+# each with its own bot session; the bot process itself moves to CONTROL_PORT on localhost.
+# Worker N also serves its metrics on localhost:CONTROL_PORT+1+N for the bot's /metrics to merge.
+# Link records are shared through LINK_DB_PATH, so that must be set.
+STREAM_WORKERS = int(os.environ.get("STREAM_WORKERS", "0"))
+CONTROL_PORT = int(os.environ.get("CONTROL_PORT", "8099"))
+STREAM_WORKER_INDEX = os.environ.get("STREAM_WORKER_INDEX", "").strip()
+MULTI_PROCESS = STREAM_WORKERS > 0 and bool(LINK_DB_PATH)
+
+# R2 codes on /{code}/{name}: "redirect" to a presigned GET, or "proxy" the bytes (Range-aware)
+R2_LINK_MODE = os.environ.get("R2_LINK_MODE", "redirect").strip().lower()
+R2_PRESIGN_TTL = int(os.environ.get("R2_PRESIGN_TTL_SEC", "3600"))
+R2_PRESIGN_CACHE_SIZE = int(os.environ.get("R2_PRESIGN_CACHE_SIZE", "2000"))
+
+# Faststart: remux MP4/MOV with the moov atom at the end (stream copy, no re-encode)
+FASTSTART_ENABLED = os.environ.get("FASTSTART", "1").strip() == "1"
+FASTSTART_TIMEOUT = int(os.environ.get("FASTSTART_TIMEOUT_SEC", "1800"))
+
+# HLS packaging ("📺 Upload as HLS"): segment length, parallel segment uploads, ffmpeg timeout
+HLS_SEGMENT_SEC = int(os.environ.get("HLS_SEGMENT_SEC", "6"))
+HLS_UPLOAD_WORKERS = int(os.environ.get("HLS_UPLOAD_WORKERS", "4"))
+HLS_TIMEOUT = int(os.environ.get("HLS_TIMEOUT_SEC", "3600"))
+
+# Content dedup: Telegram file ids and SHA-256 of content -> existing R2 key
+DEDUP_ENABLED = os.environ.get("DEDUP", "1").strip() == "1"
+DEDUP_DB_PATH = os.environ.get("DEDUP_DB_PATH", LINK_DB_PATH).strip()
+
+# Resumable jobs: download offsets and multipart UploadIds/ETags journalled here ("" = RAM only)
+CHECKPOINT_DB_PATH = os.environ.get("CHECKPOINT_DB_PATH", LINK_DB_PATH).strip()
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL_SEC", "2"))
+MULTIPART_STALE_HOURS = float(os.environ.get("MULTIPART_STALE_HOURS", "24"))
+
+# Batch ingestion: several URLs, a .txt of URLs, or a playlist becomes one pipelined job
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "200"))
+
+# Job scheduler: concurrent jobs allowed per stage (lower priority number runs first)
+JOB_STAGE_LIMITS = {
+    'download': int(os.environ.get("JOB_DOWNLOAD_SLOTS", "3")),
+    'transcode': int(os.environ.get("JOB_TRANSCODE_SLOTS", "1")),
+    'upload': int(os.environ.get("JOB_UPLOAD_SLOTS", "3")),
+}
+PRIORITY_TG, PRIORITY_URL = 3, 5
+
+# Memory governor: jobs and stream readers are admitted against a RAM budget ("0" = 90% of the
+# container's cgroup limit, split across stream worker processes); malloc trims only above the watermark
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET_MB", "0")) * 1024 * 1024
+MEMORY_HIGH_WATERMARK = float(os.environ.get("MEMORY_HIGH_WATERMARK", "0.85"))
+MEMORY_CHILD_ESTIMATE = int(os.environ.get("MEMORY_CHILD_MB", "96")) * 1024 * 1024
+MEMORY_STREAM_WAIT = float(os.environ.get("MEMORY_STREAM_WAIT_SEC", "10"))
+MEMORY_CHECK_INTERVAL, MEMORY_TRIM_SLACK = 2, 64 * 1024 * 1024
 
-global_semaphore = asyncio.Semaphore(4)
-link_storage = {}
 routes = web.RouteTableDef()
+log = logging.getLogger("tgbot")
 
 # --- 2. FILENAME CLEANERS ---
 def clean_double_extension(filename):
@@ -65,40 +195,714 @@ def get_unique_filename(filepath):
         counter += 1
     return f"{base}_{counter}{ext}"
 
+# --- 2b. COMPACT LINK STORE ---
+class LinkStore:
+    """code -> small JSON-able record, expired by TTL, capped by count, optionally mirrored to SQLite."""
+    def __init__(self, ttl, max_entries, db_path=None):
+        self.ttl, self.max_entries = ttl, max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+            # WAL lets stream worker processes read while the bot process writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS links (code TEXT PRIMARY KEY, created REAL, data TEXT)")
+            self.db.commit()
+            rows = self.db.execute("SELECT code, created, data FROM links WHERE created > ? ORDER BY created DESC LIMIT ?",
+                                   (time.time() - ttl, max_entries)).fetchall()
+            for code, created, data in reversed(rows):
+                self.cache[code] = (created, json.loads(data))
+
+    def put(self, record):
+        code = secrets.token_urlsafe(8)
+        self.update(code, record, created=time.time())
+        return code
+
+    def update(self, code, record, created=None):
+        with self.lock:
+            if created is None: created = self.cache.get(code, (time.time(), None))[0]
+            self.cache[code] = (created, record)
+            while len(self.cache) > self.max_entries:
+                old_code, _ = self.cache.popitem(last=False)
+                if self.db: self.db.execute("DELETE FROM links WHERE code = ?", (old_code,))
+            if self.db:
+                self.db.execute("INSERT OR REPLACE INTO links VALUES (?, ?, ?)", (code, created, json.dumps(record)))
+                self.db.commit()
+
+    def get(self, code):
+        with self.lock:
+            entry = self.cache.get(code)
+            if entry is None and self.db:
+                row = self.db.execute("SELECT created, data FROM links WHERE code = ?", (code,)).fetchone()
+                if row: entry = (row[0], json.loads(row[1]))
+            if entry is None: return None
+            if time.time() - entry[0] > self.ttl:
+                self._drop(code)
+                return None
+            return entry[1]
+
+    def _drop(self, code):
+        self.cache.pop(code, None)
+        if self.db:
+            self.db.execute("DELETE FROM links WHERE code = ?", (code,))
+            self.db.commit()
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            # Insertion order == creation order, so expired entries sit at the front
+            while self.cache and next(iter(self.cache.values()))[0] < cutoff:
+                self.cache.popitem(last=False)
+            if self.db:
+                self.db.execute("DELETE FROM links WHERE created < ?", (cutoff,))
+                self.db.commit()
+
+link_store = LinkStore(LINK_TTL, LINK_MAX_ENTRIES, LINK_DB_PATH or None)
+class R2RefStore:
+    """code <-> s3_key behind the "Delete from R2" buttons. One code per object, no TTL (the object
+    outlives any direct link), nothing cached in RAM, and rows follow the objects' deletes/renames."""
+    def __init__(self, max_entries, db_path=None):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(db_path or ':memory:', check_same_thread=False, timeout=10)
+        self.lock = threading.Lock()
+        if db_path: self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS r2_refs (code TEXT PRIMARY KEY, s3_key TEXT UNIQUE, created REAL, data TEXT)")
+        self.db.commit()
+
+    def ref(self, s3_key, **extra):
+        with self.lock:
+            row = self.db.execute("SELECT code FROM r2_refs WHERE s3_key = ?", (s3_key,)).fetchone()
+            if row: return row[0]
+            code = secrets.token_urlsafe(8)
+            self.db.execute("INSERT INTO r2_refs VALUES (?, ?, ?, ?)", (code, s3_key, time.time(), json.dumps(extra)))
+            # Past the cap the oldest buttons stop working; the objects themselves are untouched
+            self.db.execute("DELETE FROM r2_refs WHERE code IN (SELECT code FROM r2_refs ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self.db.commit()
+            return code
+
+    def get(self, code):
+        with self.lock:
+            row = self.db.execute("SELECT s3_key, data FROM r2_refs WHERE code = ?", (code,)).fetchone()
+        return {'s3_key': row[0], **json.loads(row[1])} if row else None
+
+    def drop_s3_key(self, s3_key):
+        with self.lock:
+            self.db.execute("DELETE FROM r2_refs WHERE s3_key = ?", (s3_key,))
+            self.db.commit()
+
+    def rename_s3_key(self, old_key, new_key):
+        with self.lock:
+            self.db.execute("DELETE FROM r2_refs WHERE s3_key = ?", (new_key,))
+            self.db.execute("UPDATE r2_refs SET s3_key = ? WHERE s3_key = ?", (new_key, old_key))
+            self.db.commit()
+
+r2_refs = R2RefStore(R2_REF_MAX_ENTRIES, LINK_DB_PATH or None)
+
+async def link_sweeper():
+    while True:
+        await asyncio.sleep(600)
+        try: link_store.sweep()
+        except Exception: pass
+
+def tg_link_record(tg_msg, filename):
+    dc_id, loc = utils.get_input_location(tg_msg.media)
+    return {
+        'kind': 'photo' if isinstance(loc, InputPhotoFileLocation) else 'doc',
+        'id': loc.id, 'access_hash': loc.access_hash, 'file_reference': loc.file_reference.hex(),
+        'thumb_size': loc.thumb_size, 'dc_id': dc_id, 'size': tg_msg.file.size,
+        'mime': tg_msg.file.mime_type, 'name': filename,
+        'chat_id': tg_msg.chat_id, 'msg_id': tg_msg.id,
+    }
+
+def tg_record_location(record):
+    cls = InputPhotoFileLocation if record['kind'] == 'photo' else InputDocumentFileLocation
+    return record['dc_id'], cls(record['id'], record['access_hash'], bytes.fromhex(record['file_reference']), record['thumb_size'])
+
 # --- 3. YT-DLP / GDRIVE ENGINE ---
-def sync_yt_dlp_download(url, custom_name=None):
+# Each job is a short-lived `python ytdlp_worker.py` child: killable on timeout/cancel
+YTDLP_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ytdlp_worker.py')
+ytdlp_slots = asyncio.Semaphore(YTDLP_WORKERS)
+ytdlp_info_cache = OrderedDict()
+
+async def run_ytdlp(func_name, *args, timeout, on_progress=None):
+    async with ytdlp_slots, governor.lease(MEMORY_CHILD_ESTIMATE, 'ytdlp'):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, YTDLP_WORKER_PATH,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            limit=64 * 1024 * 1024
+        )
+
+        async def talk():
+            proc.stdin.write(json.dumps({'func': func_name, 'args': args}).encode())
+            proc.stdin.close()
+            async for line in proc.stdout:
+                reply = json.loads(line)
+                if 'progress' in reply:
+                    if on_progress: on_progress(*reply['progress'])
+                    continue
+                if 'error' in reply: raise RuntimeError(reply['error'])
+                return reply['ok']
+            raise RuntimeError("yt-dlp worker exited unexpectedly")
+        t0, result = time.monotonic(), 'error'
+        try:
+            reply = await asyncio.wait_for(talk(), timeout)
+            result = 'ok'
+            return reply
+        except asyncio.TimeoutError:
+            result = 'timeout'
+            raise
+        finally:
+            YTDLP_RUNS.observe(time.monotonic() - t0, func=func_name, result=result)
+            if proc.returncode is None:
+                try: proc.kill()
+                except ProcessLookupError: pass
+            await proc.wait()
+
+async def yt_dlp_extract(url):
+    """Cached extract_info. "Unsupported URL" is cached like a result, so a retry goes straight to the
+    direct path; timeouts and other (possibly transient) failures only for YTDLP_FAILURE_TTL."""
+    hit = ytdlp_info_cache.get(url)
+    if hit and time.time() < hit[0]:
+        ytdlp_info_cache.move_to_end(url)
+        if isinstance(hit[1], Exception): raise hit[1]
+        return hit[1]
+    try:
+        info = await run_ytdlp('extract', url, timeout=YTDLP_EXTRACT_TIMEOUT)
+    except (RuntimeError, asyncio.TimeoutError) as e:
+        info = e
+    ttl = YTDLP_FAILURE_TTL if isinstance(info, Exception) and 'Unsupported URL' not in str(info) else YTDLP_CACHE_TTL
+    ytdlp_info_cache[url] = (time.time() + ttl, info)
+    ytdlp_info_cache.move_to_end(url)
+    while len(ytdlp_info_cache) > YTDLP_CACHE_SIZE:
+        ytdlp_info_cache.popitem(last=False)
+    if isinstance(info, Exception): raise info
+    return info
+
+async def yt_dlp_download(url, custom_name=None, on_progress=None):
     if custom_name:
         custom_name = get_unique_filename(custom_name)
         out_tmpl = custom_name
     else:
         out_tmpl = '%(title)s.%(ext)s'
 
-    ydl_opts = {
-        'outtmpl': out_tmpl,
-        'quiet': True,
-        'no_warnings': True,
-        'nocheckcertificate': True,
-        'geo_bypass': True,
-        'overwrites': True,
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        filename = ydl.prepare_filename(info)
-        cleaned = clean_double_extension(filename)
-        if cleaned != filename and os.path.exists(filename):
-            os.rename(filename, cleaned)
-            filename = cleaned
-        return filename
-
-# --- 4. C-LEVEL MEMORY PURGE ---
-def force_system_ram_purge():
-    gc.collect()
+    info = await yt_dlp_extract(url)
+    filename = await run_ytdlp('download', info, out_tmpl, timeout=YTDLP_DOWNLOAD_TIMEOUT, on_progress=on_progress)
+    cleaned = clean_double_extension(filename)
+    if cleaned != filename and os.path.exists(filename):
+        os.rename(filename, cleaned)
+        filename = cleaned
+    return filename
+
+async def yt_dlp_playlist_entries(url):
+    """Entry URLs when `url` is a playlist, else None (a single video's info stays cached for the download)."""
+    try: info = await yt_dlp_extract(url)
+    except Exception: return None
+    if info.get('_type') != 'playlist': return None
+    urls = [e.get('webpage_url') or e.get('url') for e in info.get('entries') or [] if e]
+    return [u for u in urls if u and u.startswith('http')][:BATCH_MAX_ITEMS] or None
+
+async def should_try_yt_dlp(url):
+    """Cheap pre-check so plain file links skip the yt-dlp round-trip entirely."""
+    path = unquote(url.split("?")[0].split("#")[0])
+    if os.path.splitext(path)[1].lower() in DIRECT_EXTENSIONS: return False
+    # Matching against yt-dlp's extractors happens in a worker: importing them all would cost the bot ~30 MB
+    try:
+        if await run_ytdlp('suitable', url, timeout=YTDLP_EXTRACT_TIMEOUT): return True
+    except (RuntimeError, asyncio.TimeoutError):
+        return True
+    # Only the generic extractor would apply: worth it for web pages, not for files
+    try:
+        async with get_http_session().get(url, allow_redirects=True, headers={'Range': 'bytes=0-0'}) as r:
+            return "text/html" in r.headers.get("Content-Type", "")
+    except Exception:
+        return True
+
+# --- 4. MEMORY GOVERNOR ---
+def get_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception: return 0
+
+def cgroup_memory_limit():
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f: value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 50: return int(value)
+        except Exception: pass
+    return 0
+
+def malloc_trim():
+    # ctypes drops the GIL for the call, so this is safe to run in a worker thread
     try: ctypes.CDLL('libc.so.6').malloc_trim(0)
     except Exception: pass
 
+current_lease = contextvars.ContextVar('current_lease', default=None)
+
+class MemoryAccount:
+    """Per job (or per stream): bytes reserved by its leases, bytes actually buffered, and their peaks."""
+    def __init__(self):
+        self.reserved = self.inflight = self.peak_reserved = self.peak_inflight = 0
+
+class MemoryLease:
+    def __init__(self, governor, nbytes, kind, account):
+        self.governor, self.nbytes, self.kind, self.account = governor, nbytes, kind, account
+        self.inflight, self.held = 0, False
+
+    def add(self, n):
+        # Live buffer bytes (write-behind queue, multipart parts in flight); n < 0 when they drain
+        if not self.held: return
+        self.inflight += n
+        self.account.inflight += n
+        self.governor.inflight += n
+        self.account.peak_inflight = max(self.account.peak_inflight, self.account.inflight)
+
+    def release(self):
+        if not self.held: return
+        self.add(-self.inflight)
+        self.held = False
+        self.governor._release(self)
+
+class MemoryGovernor:
+    """Admits work while RSS plus declared buffer reservations fit the budget, and hands memory
+    back to the OS from a background task instead of gc+malloc_trim on the event loop after every job."""
+    def __init__(self, budget):
+        self.budget = budget
+        self.high = int(budget * MEMORY_HIGH_WATERMARK)
+        self.reserved = self.inflight = 0
+        self.by_kind = {}
+        self.waiters = deque()
+        self.baseline = self.last_trim_rss = get_rss_bytes()
+        self.last_trim = 0
+        self.wake = None
+
+    def fits(self, nbytes):
+        # One lease always gets through, so an oversized job still runs (alone) instead of deadlocking
+        if not self.budget or not self.reserved: return True
+        return max(get_rss_bytes(), self.baseline + self.reserved) + nbytes <= self.budget
+
+    async def acquire(self, nbytes, kind, timeout=None):
+        job = current_job.get()
+        lease = MemoryLease(self, nbytes, kind, job.memory if job else MemoryAccount())
+        if not self.waiters and self.fits(nbytes):
+            self._reserve(lease)
+            return lease
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((lease, fut))
+        state = job.state if job else None
+        if job: job.state = 'waiting for memory'
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(lease, fut)
+            MEMORY_REJECTS.inc(kind=kind)
+            raise
+        except asyncio.CancelledError:
+            self._abandon(lease, fut)
+            raise
+        finally:
+            if job: job.state = state
+            MEMORY_WAIT.observe(time.monotonic() - t0, kind=kind)
+        return lease
+
+    @asynccontextmanager
+    async def lease(self, nbytes, kind, timeout=None):
+        lease = await self.acquire(nbytes, kind, timeout)
+        token = current_lease.set(lease)
+        try:
+            yield lease
+        finally:
+            current_lease.reset(token)
+            lease.release()
+
+    def _abandon(self, lease, fut):
+        # Granted in the same tick we gave up: hand the bytes back
+        if fut.done() and not fut.cancelled(): lease.release()
+        else: self.waiters = deque(w for w in self.waiters if w[1] is not fut)
+        self._pump()
+
+    def _reserve(self, lease):
+        lease.held = True
+        self.reserved += lease.nbytes
+        self.by_kind[lease.kind] = self.by_kind.get(lease.kind, 0) + lease.nbytes
+        lease.account.reserved += lease.nbytes
+        lease.account.peak_reserved = max(lease.account.peak_reserved, lease.account.reserved)
+
+    def _release(self, lease):
+        self.reserved -= lease.nbytes
+        self.by_kind[lease.kind] -= lease.nbytes
+        lease.account.reserved -= lease.nbytes
+        self._pump()
+        if not self.reserved and self.wake: self.wake.set()
+
+    def _pump(self):
+        # Strict FIFO: a big job at the head is not starved by a stream of small readers
+        while self.waiters:
+            lease, fut = self.waiters[0]
+            if fut.done():
+                self.waiters.popleft()
+                continue
+            if not self.fits(lease.nbytes): break
+            self.waiters.popleft()
+            self._reserve(lease)
+            fut.set_result(None)
+
+    async def trim(self, reason):
+        before = get_rss_bytes()
+        # A full collection pauses the loop, so it only runs while nothing is transferring
+        if reason == 'idle': gc.collect()
+        await asyncio.to_thread(malloc_trim)
+        self.last_trim, self.last_trim_rss = time.monotonic(), get_rss_bytes()
+        RAM_PURGE_FREED.observe(max(before - self.last_trim_rss, 0), reason=reason)
+
+    async def monitor(self):
+        self.wake = asyncio.Event()
+        while True:
+            try: await asyncio.wait_for(self.wake.wait(), MEMORY_CHECK_INTERVAL)
+            except asyncio.TimeoutError: pass
+            self.wake.clear()
+            rss = get_rss_bytes()
+            if not self.reserved:
+                if rss > self.baseline + MEMORY_TRIM_SLACK: await self.trim('idle')
+                self.baseline = get_rss_bytes()
+            elif self.high and rss > self.high and (time.monotonic() - self.last_trim > 30 or rss > self.last_trim_rss + MEMORY_TRIM_SLACK):
+                await self.trim('watermark')
+            # RSS may have dropped enough for whoever is queued
+            self._pump()
+
+    def nudge(self):
+        if self.wake: self.wake.set()
+
+governor = MemoryGovernor(MEMORY_BUDGET or int(cgroup_memory_limit() * 0.9 / ((STREAM_WORKERS + 1) if MULTI_PROCESS else 1)))
+
+# --- 4b. METRICS (PROMETHEUS TEXT FORMAT) ---
+# Recording is a dict update under a lock; all formatting happens only on scrape
+METRICS = []
+
+class Metric:
+    kind = 'untyped'
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labels)
+
+    def _series(self, key, suffix='', extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs: return self.name + suffix
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        inner = ','.join(f'{k}="{escape(v)}"' for k, v in pairs)
+        return f"{self.name}{suffix}{{{inner}}}"
+
+class Counter(Metric):
+    kind = 'counter'
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock: self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock: items = list(self.values.items()) or ([((), 0)] if not self.labels else [])
+        return [(self._series(k), v) for k, v in items]
+
+class Gauge(Metric):
+    kind = 'gauge'
+    def __init__(self, name, help_text, labels=(), func=None):
+        super().__init__(name, help_text, labels)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self.lock: self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock: self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.func:
+            value = self.func()
+            return [(self._series(self._key(labels)), v) for labels, v in value] if isinstance(value, list) else [(self.name, value)]
+        with self.lock: items = list(self.values.items()) or ([((), 0)] if not self.labels else [])
+        return [(self._series(k), v) for k, v in items]
+
+class Histogram(Metric):
+    kind = 'histogram'
+    def __init__(self, name, help_text, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None: counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[idx] += 1
+            counts[-1] += value
+
+    def samples(self):
+        out = []
+        with self.lock: items = [(k, list(v)) for k, v in self.values.items()]
+        for key, counts in items:
+            running = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                running += n
+                out.append((self._series(key, '_bucket', [('le', '+Inf' if bound == float('inf') else repr(bound))]), running))
+            out.append((self._series(key, '_sum'), counts[-1]))
+            out.append((self._series(key, '_count'), running))
+        return out
+
+def render_metrics(workers=()):
+    # workers: {metric name: [(series, value)]} per stream worker, folded into the same families
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{series} {value}" for series, value in metric.samples())
+        for samples in workers: lines.extend(f"{series} {value}" for series, value in samples.get(metric.name, ()))
+    return "\n".join(lines) + "\n"
+
+def worker_metric_samples(index):
+    label = f'worker="{index}"'
+    tag = lambda series: series.replace('{', '{' + label + ',', 1) if '{' in series else f"{series}{{{label}}}"
+    return {metric.name: [(tag(series), value) for series, value in metric.samples()] for metric in METRICS}
+
+SIZE_BUCKETS = tuple(2 ** n for n in range(16, 34, 2))
+TRANSFER_BYTES = Counter('tgbot_transfer_bytes_total', 'Bytes moved per pipeline stage', ['stage'])
+JOB_WAIT = Histogram('tgbot_job_stage_wait_seconds', 'Time jobs wait for a scheduler stage slot', ['stage'], buckets=(.1, .5, 1, 5, 15, 60, 300, 900, 3600))
+JOB_SLOTS = Gauge('tgbot_job_stage_jobs', 'Jobs running/waiting per scheduler stage', ['stage', 'state'], func=lambda: [
+    ({'stage': name, 'state': state}, n) for name, gate in scheduler.gates.items()
+    for state, n in (('running', gate.active), ('waiting', sum(1 for *_, f in gate.waiters if not f.done())))])
+TG_UPLOAD_PART = Histogram('tgbot_tg_upload_part_seconds', 'fast_upload SaveFilePart round-trip latency')
+TG_UPLOAD_RETRIES = Counter('tgbot_tg_upload_part_retries_total', 'fast_upload parts re-queued after a transient error', ['error'])
+TG_CHUNK_FETCH = Histogram('tgbot_tg_chunk_fetch_seconds', 'GetFile round-trip latency per 1 MiB chunk')
+ACTIVE_STREAMS = Gauge('tgbot_active_streams', 'stream_handler responses currently streaming')
+R2_CALLS = Histogram('tgbot_r2_call_seconds', 'Latency of individual R2 API calls', ['operation'])
+YTDLP_RUNS = Histogram('tgbot_ytdlp_run_seconds', 'yt-dlp child process runtime', ['func', 'result'], buckets=(1, 5, 15, 30, 60, 300, 900, 3600))
+HTTP_REQUESTS = Histogram('tgbot_http_request_seconds', 'aiohttp handler latency (until the body is sent)', ['route', 'status'])
+LOOP_LAG = Histogram('tgbot_event_loop_lag_seconds', 'Event loop scheduling delay', buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+FASTSTART_RUNS = Histogram('tgbot_faststart_remux_seconds', 'ffmpeg faststart remux runtime', ['result'], buckets=(1, 5, 15, 30, 60, 300, 900, 1800))
+HLS_RUNS = Histogram('tgbot_hls_package_seconds', 'HLS segment+upload runtime', ['mode', 'result'], buckets=(5, 15, 30, 60, 300, 900, 1800, 3600))
+TG_CACHE_LOOKUPS = Counter('tgbot_tg_cache_chunks_total', 'Stream chunk lookups in the Telegram disk cache', ['result'])
+TG_CACHE_USED = Gauge('tgbot_tg_cache_bytes', 'Bytes held in the Telegram disk cache', func=lambda: tg_cache.used if tg_cache else 0)
+FILE_SINK_WRITE = Histogram('tgbot_file_sink_write_seconds', 'Coalesced pwritev calls made by the write-behind sink writer threads')
+FILE_SINK_STALLS = Counter('tgbot_file_sink_stalls_total', 'Times a download waited because its write-behind buffer was full')
+RAM_PURGE_FREED = Histogram('tgbot_ram_purge_freed_bytes', 'RSS released by memory governor trims', ['reason'], buckets=SIZE_BUCKETS)
+MEMORY_BUDGET_BYTES = Gauge('tgbot_memory_budget_bytes', 'Memory governor admission budget (0 = unlimited)', func=lambda: governor.budget)
+MEMORY_RESERVED = Gauge('tgbot_memory_reserved_bytes', 'Buffer bytes reserved by active leases', ['kind'], func=lambda: [({'kind': k}, v) for k, v in governor.by_kind.items()])
+MEMORY_INFLIGHT = Gauge('tgbot_memory_inflight_bytes', 'Buffer bytes actually queued in write-behind sinks and multipart parts', func=lambda: governor.inflight)
+MEMORY_WAITERS = Gauge('tgbot_memory_waiters', 'Jobs and stream readers waiting for memory admission', func=lambda: len(governor.waiters))
+MEMORY_WAIT = Histogram('tgbot_memory_admission_wait_seconds', 'Time spent waiting for memory admission', ['kind'], buckets=(.001, .01, .1, 1, 5, 15, 60, 300, 900))
+MEMORY_REJECTS = Counter('tgbot_memory_admission_timeouts_total', 'Stream readers turned away (503) after waiting for memory', ['kind'])
+JOB_MEMORY = Gauge('tgbot_job_memory_bytes', 'Per-job reserved and buffered bytes', ['job', 'measure'],
+                   func=lambda: [({'job': j.id, 'measure': m}, getattr(j.memory, m)) for j in scheduler.jobs.values() for m in ('reserved', 'inflight')])
+JOB_MEMORY_PEAK = Histogram('tgbot_job_memory_peak_bytes', 'Per-job peak reserved / buffered bytes, recorded when the job ends', ['measure'], buckets=SIZE_BUCKETS)
+RSS = Gauge('tgbot_resident_memory_bytes', 'Resident set size of the bot process', func=get_rss_bytes)
+
+async def loop_lag_monitor():
+    while True:
+        t0 = time.monotonic()
+        await asyncio.sleep(0.5)
+        LOOP_LAG.observe(max(time.monotonic() - t0 - 0.5, 0))
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    t0 = time.monotonic()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        HTTP_REQUESTS.observe(time.monotonic() - t0, route=resource.canonical if resource else 'unmatched', status=status)
+
 # --- 5. SETUP CLIENT ---
-client = TelegramClient('bot_session', int(API_ID), API_HASH, connection=ConnectionTcpFull, use_ipv6=False)
+# Stream workers log in with their own session file and never take bot updates
+client = TelegramClient(f'bot_session_w{STREAM_WORKER_INDEX}' if STREAM_WORKER_INDEX else 'bot_session', int(API_ID), API_HASH,
+                        connection=ConnectionTcpFull, use_ipv6=False, receive_updates=not STREAM_WORKER_INDEX)
+
+# --- 5b. TG PARALLEL DOWNLOADER ---
+tg_sender_pool = {}
+tg_sender_lock = asyncio.Lock()
+
+async def get_tg_senders(dc_id):
+    async with tg_sender_lock:
+        if dc_id in tg_sender_pool: return tg_sender_pool[dc_id]
+        home = dc_id == client.session.dc_id
+        senders = [client._sender] if home else []
+        while len(senders) < max(TG_DOWNLOAD_SENDERS, 1):
+            if home:
+                # Extra connections to our own DC reuse the session's auth key
+                dc = await client._get_dc(dc_id)
+                sender = MTProtoSender(client.session.auth_key, loggers=client._log)
+                await sender.connect(client._connection(dc.ip_address, dc.port, dc.id, loggers=client._log, proxy=client._proxy))
+            else:
+                sender = await client._create_exported_sender(dc_id)
+            senders.append(sender)
+        tg_sender_pool[dc_id] = senders
+        return senders
+
+async def tg_fetch_chunk(sender, location, idx):
+    for attempt in range(5):
+        try:
+            t0 = time.monotonic()
+            result = await client._call(sender, GetFileRequest(location, offset=idx * TG_CHUNK_SIZE, limit=TG_CHUNK_SIZE))
+            TG_CHUNK_FETCH.observe(time.monotonic() - t0)
+            TRANSFER_BYTES.inc(len(result.bytes), stage='tg_download')
+            return result.bytes
+        except (ConnectionError, asyncio.TimeoutError, errors.ServerError, errors.TimedOutError):
+            if attempt == 4: raise
+            await asyncio.sleep(1 + attempt)
+
+async def tg_download(media, file_size, offset=0, limit=None, workers=None, cache_key=None):
+    """Yields the bytes of [offset, offset+limit) in order, fetching several 1 MiB chunks at once.
+    `media` is anything Telethon can locate, or a ready (dc_id, InputFileLocation) pair.
+    With `cache_key` (and TG_CACHE_DIR set) chunks go through the shared disk cache."""
+    end = file_size if limit is None else min(file_size, offset + limit)
+    if end <= offset: return
+    dc_id, location = media if isinstance(media, tuple) else utils.get_input_location(media)
+    senders = await get_tg_senders(dc_id)
+    first, last = offset // TG_CHUNK_SIZE, (end - 1) // TG_CHUNK_SIZE
+    window = max(workers or TG_DOWNLOAD_WORKERS, 1)
+
+    # Reorder buffer: tasks complete in any order but are awaited head-first
+    pending, next_idx = deque(), first
+    def schedule():
+        nonlocal next_idx
+        while next_idx <= last and len(pending) < window:
+            sender = senders[next_idx % len(senders)]
+            if cache_key and tg_cache:
+                fetch = lambda sender=sender, idx=next_idx: tg_fetch_chunk(sender, location, idx)
+                pending.append(asyncio.create_task(tg_cache.chunk(cache_key, file_size, next_idx, fetch)))
+            else:
+                pending.append(asyncio.create_task(tg_fetch_chunk(sender, location, next_idx)))
+            next_idx += 1
+    try:
+        schedule()
+        idx = first
+        while pending:
+            data = await pending.popleft()
+            schedule()
+            lo = offset - idx * TG_CHUNK_SIZE if idx == first else 0
+            hi = end - idx * TG_CHUNK_SIZE if idx == last else len(data)
+            if lo or hi < len(data): data = data[lo:hi]
+            if data: yield data
+            idx += 1
+    finally:
+        for task in pending: task.cancel()
+
+# --- 5c. TG CHUNK DISK CACHE ---
+class TgChunkCache:
+    """(document, chunk index) -> bytes in one sparse file per document, evicted LRU per chunk.
+    A chunk that several streams miss at once is fetched from Telegram only once."""
+    def __init__(self, root, max_bytes):
+        self.root, self.max_bytes = root, max_bytes
+        self.chunks = OrderedDict()
+        self.per_doc = {}
+        self.used = 0
+        self.inflight = {}
+        self.pins = {}
+        # The index lives in RAM, so whatever a previous run left on disk is unusable
+        shutil.rmtree(root, ignore_errors=True)
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, doc):
+        return os.path.join(self.root, f"{doc}.bin")
+
+    def has_range(self, doc, start, end):
+        return all((doc, idx) in self.chunks for idx in range(start // TG_CHUNK_SIZE, end // TG_CHUNK_SIZE + 1))
+
+    def pin(self, doc):
+        # Eviction skips documents that are being sent straight from disk
+        self.pins[doc] = self.pins.get(doc, 0) + 1
+        return self.path(doc)
+
+    def unpin(self, doc):
+        self.pins[doc] -= 1
+        if not self.pins[doc]: del self.pins[doc]
+
+    async def chunk(self, doc, file_size, idx, fetch):
+        key = (doc, idx)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            TG_CACHE_LOOKUPS.inc(result='hit')
+            return await asyncio.to_thread(self._read, doc, idx, self.chunks[key])
+        task = self.inflight.get(key)
+        TG_CACHE_LOOKUPS.inc(result='coalesced' if task else 'miss')
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(self._fill(doc, file_size, idx, fetch))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        # Shielded: one viewer disconnecting must not cancel the fetch others are waiting on
+        return await asyncio.shield(task)
+
+    async def _fill(self, doc, file_size, idx, fetch):
+        try:
+            data = await fetch()
+            await asyncio.to_thread(self._write, doc, file_size, idx, data)
+            self.chunks[(doc, idx)] = len(data)
+            self.per_doc[doc] = self.per_doc.get(doc, 0) + 1
+            self.used += len(data)
+            self._evict()
+            return data
+        finally:
+            self.inflight.pop((doc, idx), None)
+
+    def _read(self, doc, idx, n):
+        fd = os.open(self.path(doc), os.O_RDONLY)
+        try: return os.pread(fd, n, idx * TG_CHUNK_SIZE)
+        finally: os.close(fd)
+
+    def _write(self, doc, file_size, idx, data):
+        fd = os.open(self.path(doc), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Sparse, full-length file: FileResponse can serve any cached range from it directly
+            if os.fstat(fd).st_size != file_size: os.ftruncate(fd, file_size)
+            os.pwrite(fd, data, idx * TG_CHUNK_SIZE)
+        finally: os.close(fd)
+
+    def _evict(self):
+        for key in list(self.chunks):
+            if self.used <= self.max_bytes: break
+            doc, idx = key
+            if doc in self.pins: continue
+            self.used -= self.chunks.pop(key)
+            self.per_doc[doc] -= 1
+            if not self.per_doc[doc]:
+                del self.per_doc[doc]
+                try: os.remove(self.path(doc))
+                except OSError: pass
+                continue
+            try:
+                fd = os.open(self.path(doc), os.O_RDWR)
+                try: ctypes.CDLL('libc.so.6', use_errno=True).fallocate(fd, 3, ctypes.c_long(idx * TG_CHUNK_SIZE), ctypes.c_long(TG_CHUNK_SIZE))  # PUNCH_HOLE | KEEP_SIZE
+                finally: os.close(fd)
+            except Exception: pass
+
+class CachedFileResponse(web.FileResponse):
+    """sendfile() of a cached document, pinned against eviction until the body is out."""
+    def __init__(self, doc, **kwargs):
+        super().__init__(tg_cache.pin(doc), **kwargs)
+        self.doc = doc
+
+    async def prepare(self, request):
+        try: return await super().prepare(request)
+        finally:
+            if self.doc:
+                tg_cache.unpin(self.doc)
+                self.doc = None
+
+tg_cache = TgChunkCache(os.path.join(TG_CACHE_DIR, f"w{STREAM_WORKER_INDEX}" if STREAM_WORKER_INDEX else "main"), TG_CACHE_MAX_BYTES) if TG_CACHE_DIR else None
 
 # --- 6. UI HELPERS ---
 def human_size(bytes):
@@ -107,34 +911,284 @@ def human_size(bytes):
         bytes /= 1024
     return "0 B"
 
-def get_status_text(action, filename, current, total, start_time):
+def human_time(seconds):
+    seconds = int(seconds)
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+def get_status_text(action, filename, current, total, start_time, speed=None, eta=None):
     now = time.time()
     diff = now - start_time or 0.001
     perc = (current / total) * 100 if total > 0 else 0
-    speed = current / diff 
+    if speed is None: speed = current / diff 
     done = int(perc // 10)
     p_bar = "■" * done + "□" * (10 - done)
-    return (f"🚀 **{action}**\n📦 `{filename}`\n\n"
+    text = (f"🚀 **{action}**\n📦 `{filename}`\n\n"
             f"🌀 **Progress:** `[{p_bar}] {perc:.2f}%`\n"
             f"⚡ **Speed:** `{human_size(speed)}/s`\n"
             f"📂 **Size:** `{human_size(current)} / {human_size(total)}`")
+    if eta is not None: text += f"\n⏱️ **ETA:** `{human_time(eta)}`"
+    return text
+
+# --- 6b. JOB SCHEDULER ---
+current_job = contextvars.ContextVar('current_job', default=None)
+
+class StageGate:
+    """Priority semaphore: the lowest (priority, seq) waiter gets the next free slot, FIFO within a priority."""
+    def __init__(self, limit):
+        self.limit, self.active, self.waiters = max(limit, 1), 0, []
+
+    async def acquire(self, priority, seq):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, seq, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Granted a slot in the same tick we were cancelled: hand it on
+            if fut.done() and not fut.cancelled(): self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self.waiters and self.active < self.limit:
+            _, _, fut = heapq.heappop(self.waiters)
+            if fut.done(): continue
+            self.active += 1
+            fut.set_result(None)
+
+    def position(self, seq):
+        live = sorted((p, s) for p, s, f in self.waiters if not f.done())
+        return next((i + 1 for i, (_, s) in enumerate(live) if s == seq), None)
+
+class Job:
+    def __init__(self, job_id, name, priority, seq, msg):
+        self.id, self.name, self.priority, self.seq, self.msg = job_id, name, priority, seq, msg
+        self.stage, self.state = None, 'queued'
+        self.progress = None
+        self.task = None
+        self.memory = MemoryAccount()
+
+class JobScheduler:
+    def __init__(self, limits):
+        self.gates = {stage: StageGate(n) for stage, n in limits.items()}
+        self.jobs = OrderedDict()
+        self.seq = itertools.count()
+
+    def submit(self, name, priority, msg, job_fn):
+        seq = next(self.seq)
+        job = Job(f"{seq:x}", name, priority, seq, msg)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, job_fn))
+        return job
+
+    async def _run(self, job, job_fn):
+        current_job.set(job)
+        try:
+            await job_fn(job)
+        except asyncio.CancelledError:
+            try: await job.msg.edit(f"🚫 **Cancelled:** `{job.name}`")
+            except Exception: pass
+        finally:
+            self.jobs.pop(job.id, None)
+            JOB_MEMORY_PEAK.observe(job.memory.peak_reserved, measure='reserved')
+            JOB_MEMORY_PEAK.observe(job.memory.peak_inflight, measure='inflight')
+            governor.nudge()
+
+    @asynccontextmanager
+    async def stage(self, job, stage):
+        gate = self.gates[stage]
+        job.state = f"waiting for {stage}"
+        t0 = time.monotonic()
+        await gate.acquire(job.priority, job.seq)
+        JOB_WAIT.observe(time.monotonic() - t0, stage=stage)
+        job.stage, job.state = stage, 'running'
+        try:
+            yield
+        finally:
+            job.state = 'between stages'
+            gate.release()
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.task.done(): return False
+        job.task.cancel()
+        return True
+
+    def queue_text(self):
+        if not self.jobs: return "📭 **Queue is empty.**"
+        lines = ["📋 **Job Queue**\n"]
+        if governor.budget:
+            lines.insert(1, f"🧠 RSS {human_size(get_rss_bytes())} · reserved {human_size(governor.reserved)} of {human_size(governor.budget)}\n")
+        for job in self.jobs.values():
+            if job.state == 'running':
+                done, total, speed, eta = job.progress.snapshot() if job.progress else (0, 0, 0, None)
+                perc = (done / total * 100) if total else 0
+                mem = f" · 🧠 {human_size(job.memory.inflight)}/{human_size(job.memory.reserved)}" if job.memory.reserved else ""
+                lines.append(f"▶️ `{job.id}` **{job.stage}** {perc:.0f}% · {human_size(speed)}/s · ETA `{human_time(eta) if eta is not None else '?'}`{mem}\n   `{job.name}`")
+            else:
+                stage = job.state.replace('waiting for ', '')
+                pos = self.gates[stage].position(job.seq) if stage in self.gates else None
+                lines.append(f"⏳ `{job.id}` {job.state}{f' (#{pos})' if pos else ''} · P{job.priority}\n   `{job.name}`")
+        return "\n".join(lines)
+
+    def cancel_buttons(self):
+        return [[Button.inline(f"❌ Cancel {job.id}", data=f"cancel_{job.id}")] for job in self.jobs.values()] or None
+
+scheduler = JobScheduler(JOB_STAGE_LIMITS)
+
+# --- 6c. COALESCED PROGRESS REPORTER ---
+class Progress:
+    """Byte counter for one status message. add() is cheap and safe from any thread;
+    the shared ProgressHub turns it into at most one edit per PROGRESS_INTERVAL."""
+    def __init__(self, msg, action, filename, total, job=None):
+        self.msg, self.action, self.filename, self.total, self.job = msg, action, filename, total, job
+        self.done = 0
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_flush = 0
+        self.flushed_done = -1
+        self.sample_t, self.sample_done, self.speed = self.start, 0, None
+
+    def add(self, n):
+        with self.lock: self.done += n
+
+    def set(self, done, total=None):
+        with self.lock:
+            self.done = done
+            if total: self.total = total
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock: done, total = self.done, self.total
+        dt = now - self.sample_t
+        if dt >= 1:
+            # Exponentially smoothed speed so one slow chunk doesn't swing the ETA
+            inst = (done - self.sample_done) / dt
+            self.speed = inst if self.speed is None else 0.3 * inst + 0.7 * self.speed
+            self.sample_t, self.sample_done = now, done
+        speed = self.speed if self.speed is not None else done / max(now - self.start, 0.001)
+        eta = (total - done) / speed if total and speed > 0 else None
+        return done, total, speed, eta
+
+    def text(self):
+        done, total, speed, eta = self.snapshot()
+        return get_status_text(self.action, self.filename, done, total, self.start, speed=speed, eta=eta)
+
+class ProgressHub:
+    def __init__(self, interval, edits_per_min):
+        self.interval = interval
+        self.rate = edits_per_min / 60
+        self.tokens = float(edits_per_min)
+        self.capacity = float(edits_per_min)
+        self.backoff_until = 0
+        self.active = {}
+        self.flushing = {}
+        self.task = None
+
+    @asynccontextmanager
+    async def track(self, msg, action, filename, total):
+        job = current_job.get()
+        progress = Progress(msg, action, filename, total, job)
+        if job: job.progress = progress
+        self.active[id(progress)] = progress
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._loop())
+        try:
+            yield progress
+        finally:
+            self.active.pop(id(progress), None)
+            # Never let a late progress edit overwrite the caller's final message
+            pending = self.flushing.pop(id(progress), None)
+            if pending: await asyncio.wait([pending])
+
+    async def _loop(self):
+        last = time.monotonic()
+        while self.active:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - last) * self.rate)
+            last = now
+            if time.time() < self.backoff_until: continue
+            due = [p for p in self.active.values()
+                   if time.time() - p.last_flush >= self.interval and p.done != p.flushed_done and id(p) not in self.flushing]
+            # Most stale message first, so concurrent jobs share the budget fairly
+            for progress in sorted(due, key=lambda p: p.last_flush):
+                if self.tokens < 1: break
+                self.tokens -= 1
+                progress.last_flush, progress.flushed_done = time.time(), progress.done
+                self.flushing[id(progress)] = asyncio.create_task(self._flush(progress))
+
+    async def _flush(self, progress):
+        buttons = [[Button.inline("❌ Cancel", data=f"cancel_{progress.job.id}")]] if progress.job else None
+        try:
+            await progress.msg.edit(progress.text(), buttons=buttons)
+        except errors.FloodWaitError as e:
+            self.backoff_until = time.time() + e.seconds
+        except Exception:
+            pass
+        finally:
+            self.flushing.pop(id(progress), None)
+
+progress_hub = ProgressHub(PROGRESS_INTERVAL, PROGRESS_EDITS_PER_MIN)
 
 # --- 7. R2 CLIENT & SYNC S3 OPERATIONS ---
+r2_client = None
+r2_client_lock = threading.Lock()
+
 def get_r2_client():
-    clean_id = R2_ACCOUNT_ID.replace("https://", "").replace("http://", "").split(".")[0].strip('/')
-    endpoint = f"https://{clean_id}.r2.cloudflarestorage.com"
-    r2_config = Config(region_name='auto', signature_version='s3v4')
-    return boto3.client(
-        's3',
-        endpoint_url=endpoint,
-        aws_access_key_id=R2_ACCESS_KEY_ID,
-        aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-        config=r2_config
+    # boto3 clients are thread-safe: build one lazily and share its connection pool
+    global r2_client
+    if r2_client is not None: return r2_client
+    with r2_client_lock:
+        if r2_client is None:
+            clean_id = R2_ACCOUNT_ID.replace("https://", "").replace("http://", "").split(".")[0].strip('/')
+            endpoint = f"https://{clean_id}.r2.cloudflarestorage.com"
+            r2_config = Config(
+                region_name='auto', signature_version='s3v4',
+                max_pool_connections=R2_MAX_POOL, tcp_keepalive=True,
+                retries={'max_attempts': 5, 'mode': 'standard'}
+            )
+            s3 = boto3.client(
+                's3',
+                endpoint_url=endpoint,
+                aws_access_key_id=R2_ACCESS_KEY_ID,
+                aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+                config=r2_config
+            )
+            s3.meta.events.register('before-call.s3', r2_call_started)
+            s3.meta.events.register('after-call.s3', r2_call_finished)
+            r2_client = s3
+    return r2_client
+
+def r2_call_started(context, **kwargs):
+    context['metrics_t0'] = time.monotonic()
+
+def r2_call_finished(context, model, **kwargs):
+    if 'metrics_t0' in context: R2_CALLS.observe(time.monotonic() - context['metrics_t0'], operation=model.name)
+
+def get_transfer_config(file_size):
+    chunk = R2_MULTIPART_CHUNK
+    while math.ceil(file_size / chunk) > 10000:
+        chunk *= 2
+    parts = max(math.ceil(file_size / chunk), 1)
+    return TransferConfig(
+        multipart_threshold=R2_MULTIPART_THRESHOLD,
+        multipart_chunksize=chunk,
+        max_concurrency=max(1, min(R2_MAX_CONCURRENCY, parts, R2_MAX_POOL)),
+        use_threads=True
     )
 
-def sync_get_r2_files():
+def sync_list_r2_objects():
     s3 = get_r2_client()
-    return s3.list_objects_v2(Bucket=R2_BUCKET_NAME)
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=R2_BUCKET_NAME):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['Size'], obj['LastModified'].timestamp())
+    return objects
 
 def sync_delete_r2_file(s3_key):
     s3 = get_r2_client()
@@ -145,57 +1199,520 @@ def sync_rename_r2_file(old_key, new_key):
     s3.copy({'Bucket': R2_BUCKET_NAME, 'Key': old_key}, R2_BUCKET_NAME, new_key)
     s3.delete_object(Bucket=R2_BUCKET_NAME, Key=old_key)
 
-def sync_r2_upload(filename, s3_key, loop, status_msg, start_t):
+def sync_list_r2_keys(prefix, on_progress=None):
+    s3 = get_r2_client()
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=R2_BUCKET_NAME, Prefix=prefix):
+        keys.extend((obj['Key'], obj['Size']) for obj in page.get('Contents', []))
+        if on_progress: on_progress(len(keys))
+    return keys
+
+def sync_delete_r2_batch(keys):
+    # delete_objects takes up to 1000 keys per round-trip
+    s3 = get_r2_client()
+    failed = []
+    for i in range(0, len(keys), 1000):
+        resp = s3.delete_objects(Bucket=R2_BUCKET_NAME, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]], 'Quiet': True})
+        failed.extend(err['Key'] for err in resp.get('Errors', []))
+    return failed
+
+def sync_copy_r2_object(old_key, new_key, size):
+    s3 = get_r2_client()
+    if size < 5 * 1024**3:
+        s3.copy_object(Bucket=R2_BUCKET_NAME, Key=new_key, CopySource={'Bucket': R2_BUCKET_NAME, 'Key': old_key}, MetadataDirective='COPY')
+    else:
+        # Single-request copies stop at 5 GiB; the managed copy switches to UploadPartCopy
+        s3.copy({'Bucket': R2_BUCKET_NAME, 'Key': old_key}, R2_BUCKET_NAME, new_key, Config=get_transfer_config(size))
+
+def sync_r2_upload(filename, s3_key, progress, cancel=None):
     s3 = get_r2_client()
     file_size = os.path.getsize(filename)
     
     mime_type, _ = mimetypes.guess_type(filename)
     if not mime_type: mime_type = 'video/mp4'
 
-    class ProgressCallback:
-        def __init__(self):
-            self.seen = 0
-            self.last_update = 0
-        def __call__(self, bytes_amount):
-            self.seen += bytes_amount
-            now = time.time()
-            if now - self.last_update > 4:
-                self.last_update = now
-                try:
-                    text = get_status_text("R2 Uploading", os.path.basename(filename), self.seen, file_size, start_t)
-                    asyncio.run_coroutine_threadsafe(status_msg.edit(text), loop)
-                except: pass
-
     extra_args = {
         'ContentType': mime_type,
         'ContentDisposition': 'inline'
     }
 
+    def on_bytes(n):
+        # Raising here fails the transfer, and boto3 aborts its own multipart upload
+        if cancel and cancel.is_set(): raise RuntimeError("R2 upload cancelled")
+        progress.add(n)
+        TRANSFER_BYTES.inc(n, stage='r2_upload')
+
     s3.upload_file(
         filename, 
         R2_BUCKET_NAME, 
         s3_key, 
-        Callback=ProgressCallback(), 
-        ExtraArgs=extra_args
+        Callback=on_bytes, 
+        ExtraArgs=extra_args,
+        Config=get_transfer_config(file_size)
     )
 
-async def upload_to_r2(filename, status_msg):
-    start_t = time.time()
-    loop = asyncio.get_running_loop()
-    
+def make_r2_key(basename):
     now = datetime.datetime.now()
+    return f"{now.year}/{now.month}/{now.day}/{basename}"
+
+def r2_public_url(s3_key):
+    return f"{R2_PUBLIC_URL}/{quote(s3_key, safe='/')}"
+
+def register_r2_link(s3_key):
+    return r2_public_url(s3_key), r2_refs.ref(s3_key)
+
+# Presigning is local HMAC work; the cache just keeps redirects stable and cheap.
+# Entries are dropped well before the signature itself runs out.
+presign_cache = OrderedDict()
+
+def get_presigned_url(s3_key, method='GET'):
+    # SigV4 signs the HTTP method, so a HEAD needs its own head_object signature
+    now, cache_key = time.time(), (method, s3_key)
+    hit = presign_cache.get(cache_key)
+    if hit and hit[1] > now:
+        presign_cache.move_to_end(cache_key)
+        return hit[0]
+    url = get_r2_client().generate_presigned_url(
+        'head_object' if method == 'HEAD' else 'get_object', Params={'Bucket': R2_BUCKET_NAME, 'Key': s3_key}, ExpiresIn=R2_PRESIGN_TTL)
+    presign_cache[cache_key] = (url, now + R2_PRESIGN_TTL * 0.8)
+    presign_cache.move_to_end(cache_key)
+    while len(presign_cache) > R2_PRESIGN_CACHE_SIZE: presign_cache.popitem(last=False)
+    return url
+
+async def upload_to_r2(filename, status_msg, content_keys=(), checkpoint=None, register=True):
     basename = os.path.basename(filename)
-    s3_key = f"{now.year}/{now.month}/{now.day}/{basename}"
+    # Big checkpointed uploads use our own journalled multipart so a restart resumes them
+    resumable = checkpoint is not None and os.path.getsize(filename) >= R2_MULTIPART_THRESHOLD
+    upload_id, etags = await resume_multipart(checkpoint) if resumable else (None, {})
+    s3_key = checkpoint.data['upload']['s3_key'] if upload_id else make_r2_key(basename)
     
     await status_msg.edit(f"⬆️ **Connecting to Cloudflare R2...**\n🎬 `{basename}`")
-    await asyncio.to_thread(sync_r2_upload, filename, s3_key, loop, status_msg, start_t)
-    
-    code = secrets.token_urlsafe(8)
-    link_storage[code] = {'s3_key': s3_key}
+    # boto3 (and the resumable path) hold up to max_concurrency parts in RAM
+    config = get_transfer_config(os.path.getsize(filename))
+    async with governor.lease(min(config.multipart_chunksize * config.max_concurrency, os.path.getsize(filename)), 'r2_upload'), progress_hub.track(status_msg, "R2 Uploading", basename, os.path.getsize(filename)) as progress:
+        cancel = threading.Event()
+        if resumable: work = asyncio.to_thread(sync_r2_upload_resumable, filename, s3_key, progress, checkpoint, upload_id, etags, cancel)
+        else: work = asyncio.to_thread(sync_r2_upload, filename, s3_key, progress, cancel)
+        upload = asyncio.ensure_future(work)
+        try:
+            await asyncio.shield(upload)
+        except asyncio.CancelledError:
+            # The thread can't be cancelled: flag it and wait for it to stop (and abort) before the job removes the file
+            cancel.set()
+            try: await upload
+            except Exception: pass
+            raise
+    r2_index.add(s3_key, os.path.getsize(filename))
+    # Keys are per day + basename, so this may have replaced another file: its content rows are stale now
+    content_index.drop_s3_key(s3_key)
+    remember_content(content_keys, s3_key)
     
-    public_link = f"{R2_PUBLIC_URL}/{quote(s3_key, safe='/')}"
-    return public_link, code
+    # Batch summaries carry no Delete buttons, so they only need the public URL
+    return register_r2_link(s3_key) if register else r2_public_url(s3_key)
+
+# --- 7a. CACHED R2 OBJECT INDEX ---
+class R2Index:
+    """key -> (size, mtime) for the whole bucket, refreshed every R2_INDEX_REFRESH seconds
+    and patched in place by our own uploads, deletes, renames and moves."""
+    SORT_KEYS = {'name': lambda kv: kv[0], 'size': lambda kv: kv[1][0], 'date': lambda kv: kv[1][1]}
+
+    def __init__(self):
+        self.objects = {}
+        self.loaded_at = 0
+        self.version = 0
+        self.lock = asyncio.Lock()
+        self.journal = None
+        self.sorted_cache = {}
+        self.refresher, self.retry_at = None, 0
+
+    async def ensure_fresh(self, force=False):
+        # Only the very first load (or an explicit refresh) blocks; after that pages are served
+        # from the stale index while a background task re-lists the bucket
+        if force or not self.loaded_at: return await self.refresh(force)
+        if time.time() - self.loaded_at < R2_INDEX_REFRESH or time.time() < self.retry_at: return
+        if not self.refresher or self.refresher.done():
+            self.refresher = asyncio.create_task(self._refresh_in_background())
+
+    async def _refresh_in_background(self):
+        try: await self.refresh()
+        except Exception: self.retry_at = time.time() + 30
+
+    async def refresh(self, force=False):
+        async with self.lock:
+            if not force and time.time() - self.loaded_at < R2_INDEX_REFRESH: return
+            # Our own mutations during a (possibly long) listing are replayed on top of it
+            self.journal = []
+            try:
+                objects = await asyncio.to_thread(sync_list_r2_objects)
+                for op, args in self.journal:
+                    if op == 'add': objects[args[0]] = args[1]
+                    elif op == 'remove': objects.pop(args[0], None)
+                self.objects, self.loaded_at = objects, time.time()
+                self._touch()
+            finally:
+                self.journal = None
+
+    def _touch(self):
+        self.version += 1
+        self.sorted_cache.clear()
+
+    def _apply(self, op, *args):
+        if self.journal is not None: self.journal.append((op, args))
+        if op == 'add': self.objects[args[0]] = args[1]
+        else: self.objects.pop(args[0], None)
+        self._touch()
+
+    def add(self, key, size, mtime=None):
+        self._apply('add', key, (size, mtime or time.time()))
+
+    def remove(self, key):
+        self._apply('remove', key)
+
+    def rename(self, old_key, new_key):
+        entry = self.objects.get(old_key)
+        self.remove(old_key)
+        if entry: self.add(new_key, entry[0])
+
+    def query(self, q='', prefix='', sort='date', order='desc', offset=0, limit=DASHBOARD_PAGE_SIZE):
+        sort = sort if sort in self.SORT_KEYS else 'date'
+        reverse = order != 'asc'
+        items = self.sorted_cache.get((sort, reverse))
+        if items is None:
+            items = sorted(self.objects.items(), key=self.SORT_KEYS[sort], reverse=reverse)
+            self.sorted_cache[(sort, reverse)] = items
+        if prefix or q:
+            q = q.lower()
+            items = [kv for kv in items if kv[0].startswith(prefix) and q in kv[0].lower()]
+        return len(items), items[offset:offset + limit]
+
+    def totals(self):
+        return len(self.objects), sum(size for size, _ in self.objects.values())
+
+r2_index = R2Index()
+
+# --- 7b. STREAMING MULTIPART UPLOAD (NO DISK) ---
+def r2_part_size(total_size):
+    # R2 wants equal-sized parts (except the last) and at most 10k of them
+    part_size = max(R2_STREAM_PART_SIZE, 5 * 1024 * 1024)
+    while total_size and math.ceil(total_size / part_size) > 10000:
+        part_size *= 2
+    return part_size
+
+async def stream_to_r2(chunks, s3_key, total_size, mime_type, status_msg, label, hasher=None, checkpoint=None, upload_id=None, etags=None):
+    """`chunks` must start at the end of the parts already in `etags` when resuming `upload_id`."""
+    s3 = get_r2_client()
+    part_size = checkpoint.data['upload']['part_size'] if upload_id else r2_part_size(total_size)
+    etags = dict(etags or {})
+    if upload_id is None:
+        mpu = await asyncio.to_thread(
+            s3.create_multipart_upload, Bucket=R2_BUCKET_NAME, Key=s3_key,
+            ContentType=mime_type, ContentDisposition='inline'
+        )
+        upload_id = mpu['UploadId']
+    if checkpoint:
+        checkpoint.update(upload={'s3_key': s3_key, 'upload_id': upload_id, 'part_size': part_size, 'parts': {str(n): e for n, e in etags.items()}})
+
+    # maxsize=1 keeps peak RAM at roughly (workers + 2) parts
+    queue = asyncio.Queue(maxsize=1)
+    errors = []
+    lease = current_lease.get()
+
+    async def part_worker():
+        while True:
+            item = await queue.get()
+            if item is None: return
+            if errors: continue
+            part_no, body = item
+            try:
+                resp = await asyncio.to_thread(
+                    s3.upload_part, Bucket=R2_BUCKET_NAME, Key=s3_key,
+                    UploadId=upload_id, PartNumber=part_no, Body=body
+                )
+                etags[part_no] = resp['ETag']
+                if checkpoint: checkpoint.add_part(part_no, resp['ETag'])
+                TRANSFER_BYTES.inc(len(body), stage='r2_upload')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if lease: lease.add(-len(body))
+
+    async def put_part(part_no, body):
+        if errors: raise errors[0]
+        if lease: lease.add(len(body))
+        await queue.put((part_no, body))
+
+    workers = [asyncio.create_task(part_worker()) for _ in range(R2_STREAM_WORKERS)]
+    try:
+        buf, part_no, received = bytearray(), len(etags) + 1, len(etags) * part_size
+        async with progress_hub.track(status_msg, label, os.path.basename(s3_key), total_size) as progress:
+            progress.add(received)
+            async for chunk in chunks:
+                buf += chunk
+                received += len(chunk)
+                progress.add(len(chunk))
+                if hasher: hasher.update(chunk)
+                while len(buf) >= part_size:
+                    await put_part(part_no, bytes(buf[:part_size]))
+                    del buf[:part_size]
+                    part_no += 1
+        if buf or part_no == 1:
+            await put_part(part_no, bytes(buf))
+        del buf
+        for _ in workers: await queue.put(None)
+        await asyncio.gather(*workers)
+        if errors: raise errors[0]
+
+        await asyncio.to_thread(
+            s3.complete_multipart_upload, Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]}
+        )
+        r2_index.add(s3_key, received)
+        content_index.drop_s3_key(s3_key)
+    except BaseException:
+        for w in workers: w.cancel()
+        try: await asyncio.to_thread(s3.abort_multipart_upload, Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id)
+        except Exception: pass
+        raise
+
+async def stream_tg_to_r2(tg_msg, filename, status_msg, checkpoint=None):
+    mime_type = tg_msg.file.mime_type or mimetypes.guess_type(filename)[0] or 'video/mp4'
+    upload_id, etags = await resume_multipart(checkpoint)
+    s3_key = checkpoint.data['upload']['s3_key'] if upload_id else make_r2_key(filename)
+    await status_msg.edit(f"⬆️ **Streaming Telegram → Cloudflare R2...**\n🎬 `{filename}`")
+    # A resumed upload restarts the Telegram download right after its last finished part
+    offset = len(etags) * checkpoint.data['upload']['part_size'] if upload_id else 0
+    chunks = tg_download(tg_msg.media, tg_msg.file.size, offset=offset)
+    hasher = None if offset else hashlib.sha256()
+    buffers = r2_part_size(tg_msg.file.size) * (R2_STREAM_WORKERS + 2) + TG_DOWNLOAD_WORKERS * TG_CHUNK_SIZE
+    async with governor.lease(buffers, 'r2_stream'):
+        await stream_to_r2(chunks, s3_key, tg_msg.file.size, mime_type, status_msg, "TG → R2 Streaming", hasher=hasher,
+                           checkpoint=checkpoint, upload_id=upload_id, etags=etags)
+    content_keys = [tg_content_key(tg_msg)]
+    if hasher:
+        # The hash is only known once the bytes went through; keep the older copy if there is one
+        hash_key = f"sha256:{hasher.hexdigest()}"
+        s3_key = await settle_duplicate(hash_key, s3_key)
+        content_keys.append(hash_key)
+    remember_content(content_keys, s3_key)
+    return register_r2_link(s3_key)
+
+# --- 7c. CONTENT DEDUP INDEX ---
+class ContentIndex:
+    """content key ('tg:<file id>' / 'sha256:<hex>') -> s3_key, in SQLite (file or :memory:)."""
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path or ':memory:', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS content (key TEXT PRIMARY KEY, s3_key TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS content_s3_key ON content (s3_key)")
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT s3_key FROM content WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, s3_key):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO content VALUES (?, ?)", (key, s3_key))
+            self.db.commit()
+
+    def drop_s3_key(self, s3_key):
+        with self.lock:
+            self.db.execute("DELETE FROM content WHERE s3_key = ?", (s3_key,))
+            self.db.commit()
+
+    def rename_s3_key(self, old_key, new_key):
+        with self.lock:
+            # Whatever used to live at new_key has just been overwritten
+            self.db.execute("DELETE FROM content WHERE s3_key = ?", (new_key,))
+            self.db.execute("UPDATE content SET s3_key = ? WHERE s3_key = ?", (new_key, old_key))
+            self.db.commit()
+
+content_index = ContentIndex(DEDUP_DB_PATH)
+
+def tg_content_key(tg_msg):
+    _, loc = utils.get_input_location(tg_msg.media)
+    return f"tg:{loc.id}"
+
+def file_content_key(filename):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while block := f.read(8 * 1024 * 1024):
+            hasher.update(block)
+    return f"sha256:{hasher.hexdigest()}"
+
+def remember_content(keys, s3_key):
+    if not DEDUP_ENABLED: return
+    for key in keys:
+        if key: content_index.put(key, s3_key)
+
+def sync_r2_object_exists(s3_key):
+    try:
+        get_r2_client().head_object(Bucket=R2_BUCKET_NAME, Key=s3_key)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'): return False
+        raise
+
+async def find_duplicate(key):
+    if not DEDUP_ENABLED or not key: return None
+    s3_key = content_index.get(key)
+    if not s3_key: return None
+    # The index can be stale (objects removed outside the bot): confirm with the bucket
+    if await asyncio.to_thread(sync_r2_object_exists, s3_key): return s3_key
+    content_index.drop_s3_key(s3_key)
+    r2_refs.drop_s3_key(s3_key)
+    return None
+
+async def settle_duplicate(key, new_s3_key):
+    existing = await find_duplicate(key)
+    if not existing or existing == new_s3_key: return new_s3_key
+    await asyncio.to_thread(sync_delete_r2_file, new_s3_key)
+    r2_index.remove(new_s3_key)
+    return existing
+
+async def reply_duplicate(msg, s3_key):
+    r2_url, code = register_r2_link(s3_key)
+    await msg.edit(
+        f"♻️ **Already in R2, skipped re-upload!**\n\n🎬 `{os.path.basename(s3_key)}`\n🔗 `{r2_url}`",
+        buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]]
+    )
+
+# --- 7d. TRANSFER CHECKPOINTS ---
+class Checkpoint:
+    """One job's resume state. Offsets are written at most every CHECKPOINT_INTERVAL; parts at once."""
+    def __init__(self, journal, cp_id, data):
+        self.journal, self.id, self.data = journal, cp_id, data
+        self.saved_at = 0
+
+    def update(self, throttle=False, **fields):
+        self.data.update(fields)
+        if throttle and time.monotonic() - self.saved_at < CHECKPOINT_INTERVAL: return
+        self.saved_at = time.monotonic()
+        self.journal.save(self)
+
+    def add_part(self, part_no, etag):
+        self.data['upload']['parts'][str(part_no)] = etag
+        self.update()
+
+    def parts(self):
+        up = self.data.get('upload') or {}
+        return {int(n): etag for n, etag in up.get('parts', {}).items()}
+
+    def drop(self):
+        self.journal.drop(self.id)
+
+class CheckpointJournal:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path or ':memory:', check_same_thread=False, timeout=10)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (id TEXT PRIMARY KEY, updated REAL, data TEXT)")
+        self.db.commit()
+
+    def open(self, kind, **fields):
+        cp = Checkpoint(self, secrets.token_hex(6), {'kind': kind, **fields})
+        self.save(cp)
+        return cp
+
+    def save(self, cp):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)", (cp.id, time.time(), json.dumps(cp.data)))
+            self.db.commit()
+
+    def drop(self, cp_id):
+        with self.lock:
+            self.db.execute("DELETE FROM checkpoints WHERE id = ?", (cp_id,))
+            self.db.commit()
+
+    def all(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, data FROM checkpoints ORDER BY updated").fetchall()
+        return [Checkpoint(self, cp_id, json.loads(data)) for cp_id, data in rows]
+
+checkpoints = CheckpointJournal(CHECKPOINT_DB_PATH)
+
+def sync_r2_list_parts(s3_key, upload_id):
+    """ETags R2 already holds for an open multipart upload, or None if it was completed/aborted."""
+    s3 = get_r2_client()
+    parts = {}
+    try:
+        for page in s3.get_paginator('list_parts').paginate(Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id):
+            parts.update((p['PartNumber'], p['ETag']) for p in page.get('Parts', []))
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchUpload', '404', 'NotFound'): return None
+        raise
+    return parts
+
+async def resume_multipart(checkpoint):
+    """(upload_id, etags) to continue a checkpointed upload from, trusting R2 over the journal.
+    Only the contiguous prefix of parts is kept, so the source can simply restart at one offset."""
+    up = checkpoint.data.get('upload') if checkpoint else None
+    if not up: return None, {}
+    parts = await asyncio.to_thread(sync_r2_list_parts, up['s3_key'], up['upload_id'])
+    if parts is None: return None, {}
+    done = {}
+    while len(done) + 1 in parts: done[len(done) + 1] = parts[len(done) + 1]
+    return up['upload_id'], done
+
+def sync_r2_upload_resumable(filename, s3_key, progress, checkpoint, upload_id=None, etags=None, cancel=None):
+    """Multipart upload of a local file that journals each part, so a restart skips finished parts."""
+    s3 = get_r2_client()
+    file_size = os.path.getsize(filename)
+    part_size = (checkpoint.data.get('upload') or {}).get('part_size') if upload_id else None
+    part_size = part_size or r2_part_size(file_size)
+    etags = dict(etags or {})
+    if upload_id is None:
+        mime_type = mimetypes.guess_type(filename)[0] or 'video/mp4'
+        upload_id = s3.create_multipart_upload(Bucket=R2_BUCKET_NAME, Key=s3_key, ContentType=mime_type, ContentDisposition='inline')['UploadId']
+    checkpoint.update(upload={'s3_key': s3_key, 'upload_id': upload_id, 'part_size': part_size, 'parts': {str(n): e for n, e in etags.items()}})
+    progress.add(min(len(etags) * part_size, file_size))
+
+    def put_part(part_no):
+        if cancel and cancel.is_set(): raise RuntimeError("R2 upload cancelled")
+        with open(filename, 'rb') as f:
+            f.seek((part_no - 1) * part_size)
+            body = f.read(part_size)
+        etag = s3.upload_part(Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id, PartNumber=part_no, Body=body)['ETag']
+        progress.add(len(body))
+        TRANSFER_BYTES.inc(len(body), stage='r2_upload')
+        return part_no, etag
 
+    todo = [n for n in range(1, max(math.ceil(file_size / part_size), 1) + 1) if n not in etags]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(R2_MAX_CONCURRENCY, R2_MAX_POOL))) as pool:
+            for part_no, etag in pool.map(put_part, todo):
+                etags[part_no] = etag
+                checkpoint.add_part(part_no, etag)
+    except Exception:
+        # A cancelled job drops its checkpoint, so nothing would ever resume these parts
+        if cancel and cancel.is_set():
+            try: s3.abort_multipart_upload(Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id)
+            except Exception: pass
+        raise
+    s3.complete_multipart_upload(Bucket=R2_BUCKET_NAME, Key=s3_key, UploadId=upload_id,
+                                 MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]})
+
+def sync_abort_stale_multipart(live_upload_ids):
+    s3 = get_r2_client()
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=MULTIPART_STALE_HOURS)
+    aborted = 0
+    for page in s3.get_paginator('list_multipart_uploads').paginate(Bucket=R2_BUCKET_NAME):
+        for up in page.get('Uploads', []):
+            if up['UploadId'] in live_upload_ids or up['Initiated'] > cutoff: continue
+            try:
+                s3.abort_multipart_upload(Bucket=R2_BUCKET_NAME, Key=up['Key'], UploadId=up['UploadId'])
+                aborted += 1
+            except Exception: pass
+    return aborted
+
+async def multipart_reaper():
+    # Parts of an abandoned upload are billed storage until the upload is aborted
+    while True:
+        try:
+            live = {(cp.data.get('upload') or {}).get('upload_id') for cp in checkpoints.all()}
+            await asyncio.to_thread(sync_abort_stale_multipart, live)
+        except Exception: pass
+        await asyncio.sleep(3600)
 
 # ============================================
 # --- 8. SECURED WEB DASHBOARD & UI ---
@@ -226,6 +1743,9 @@ DASHBOARD_CSS = """
     td { padding: 16px; border-bottom: 1px solid var(--border); font-size: 14px; word-break: break-all; color: #cbd5e1; }
     tr:last-child td { border-bottom: none; }
     tr:hover { background: #334155; }
+    .sort-link { color: inherit; text-decoration: none; }
+    .bulk-status { display: none; background: var(--card); border: 1px solid var(--border); border-radius: 8px; padding: 10px 15px; margin-bottom: 15px; color: var(--accent); font-size: 14px; }
+    .pager { display: flex; gap: 10px; align-items: center; justify-content: flex-end; margin-top: 15px; color: var(--muted); font-size: 13px; }
 
     /* Actions */
     .actions { display: flex; gap: 8px; flex-wrap: wrap; }
@@ -260,6 +1780,55 @@ DASHBOARD_JS = """
         }
     }
     
+    function selectedKeys() {
+        return Array.from(document.querySelectorAll('.row-check:checked')).map(c => decodeURIComponent(c.value));
+    }
+
+    function toggleAll(box) {
+        document.querySelectorAll('.row-check').forEach(c => c.checked = box.checked);
+    }
+
+    async function runBulk(payload) {
+        let bar = document.getElementById('bulkStatus');
+        bar.style.display = 'block';
+        bar.innerText = '⏳ Starting...';
+        let resp = await fetch('/api/bulk', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload) });
+        let task = await resp.json();
+        if (!resp.ok) { bar.innerText = '❌ ' + task.error; return; }
+        while (true) {
+            let st = await (await fetch('/api/bulk/' + task.task_id)).json();
+            let count = st.phase === 'listing' ? 'listing… ' + st.done + ' found' : st.phase + ' ' + st.done + ' / ' + st.total;
+            bar.innerText = (st.state === 'running' ? '⏳ ' : st.state === 'failed' ? '❌ ' : '✅ ') + st.action + ': ' + count + (st.errors.length ? ' · ' + st.errors.length + ' failed' : '') + (st.error ? ' · ' + st.error : '');
+            if (st.errors.length && st.state !== 'running') bar.innerText += '\\n' + st.errors.slice(0, 10).join('\\n');
+            if (st.state !== 'running') { if (!st.errors.length && !st.error) setTimeout(() => location.reload(), 800); return; }
+            await new Promise(r => setTimeout(r, 1000));
+        }
+    }
+
+    function bulkDelete() {
+        let keys = selectedKeys();
+        if (keys.length && confirm('⚠️ PERMANENTLY DELETE ' + keys.length + ' files?')) runBulk({ action: 'delete', keys: keys });
+    }
+
+    function bulkMove() {
+        let keys = selectedKeys();
+        if (!keys.length) return;
+        let target = prompt('📁 Move ' + keys.length + ' files to folder:', '');
+        if (target !== null) runBulk({ action: 'move', keys: keys, target: target });
+    }
+
+    function prefixDelete() {
+        let prefix = prompt('🧹 Delete EVERYTHING under folder/prefix (e.g. 2026/1/15/):', '');
+        if (prefix && confirm('⚠️ PERMANENTLY DELETE all files under: \n' + prefix)) runBulk({ action: 'delete', prefix: prefix });
+    }
+
+    function prefixMove() {
+        let prefix = prompt('📦 Folder/prefix to move (e.g. 2026/1/15/):', '');
+        if (!prefix) return;
+        let target = prompt('📁 Move everything under "' + prefix + '" into:', '');
+        if (target !== null) runBulk({ action: 'move', prefix: prefix, target: target });
+    }
+
     function moveFolder(key) {
         let decodedKey = decodeURIComponent(key);
         let currentDir = decodedKey.includes('/') ? decodedKey.substring(0, decodedKey.lastIndexOf('/')) : '';
@@ -268,41 +1837,6 @@ DASHBOARD_JS = """
             window.location.href = '/move_file?old_key=' + encodeURIComponent(decodedKey) + '&target_folder=' + encodeURIComponent(targetFolder);
         }
     }
-
-    function filterTable() {
-        let input = document.getElementById("searchInput").value.toLowerCase();
-        let rows = document.querySelectorAll("tbody tr");
-        rows.forEach(row => {
-            let filename = row.querySelector(".file-name")?.innerText.toLowerCase() || "";
-            row.style.display = filename.includes(input) ? "" : "none";
-        });
-    }
-
-    let currentSort = { col: -1, dir: 'asc' };
-    function sortTable(colIndex, type) {
-        let table = document.querySelector("tbody");
-        let rows = Array.from(table.querySelectorAll("tr"));
-        if (rows.length === 0 || rows[0].querySelector("td[colspan]")) return;
-
-        let dir = (currentSort.col === colIndex && currentSort.dir === 'asc') ? 'desc' : 'asc';
-        currentSort = { col: colIndex, dir: dir };
-
-        rows.sort((a, b) => {
-            let valA = a.children[colIndex].getAttribute("data-val");
-            let valB = b.children[colIndex].getAttribute("data-val");
-            if (type === 'num') {
-                return dir === 'asc' ? parseFloat(valA) - parseFloat(valB) : parseFloat(valB) - parseFloat(valA);
-            } else {
-                return dir === 'asc' ? valA.localeCompare(valB) : valB.localeCompare(valA);
-            }
-        });
-
-        table.innerHTML = "";
-        rows.forEach(row => table.appendChild(row));
-
-        document.querySelectorAll("th span").forEach(span => span.innerText = "");
-        document.getElementById("th-" + colIndex).querySelector("span").innerText = dir === 'asc' ? ' 🔼' : ' 🔽';
-    }
 """
 
 def check_dashboard_auth(request):
@@ -317,6 +1851,26 @@ def check_dashboard_auth(request):
     except Exception:
         return False
 
+def render_file_row(name, size_bytes, timestamp):
+    url = f"{R2_PUBLIC_URL}/{quote(name, safe='/')}"
+    js_key = quote(name, safe='')
+    return f"""
+                <tr>
+                    <td><input type="checkbox" class="row-check" value="{js_key}"></td>
+                    <td><span class="file-name">{html.escape(name)}</span></td>
+                    <td>{human_size(size_bytes)}</td>
+                    <td>{datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")}</td>
+                    <td>
+                        <div class="actions">
+                            <button class="btn btn-copy" onclick="copyText('{html.escape(url)}')" title="Copy URL">🔗 Copy</button>
+                            <a href="{html.escape(url)}" target="_blank" class="btn btn-view" title="Play Video">▶️ Play</a>
+                            <button class="btn btn-move" onclick="moveFolder('{js_key}')" title="Move to Folder">📁 Move</button>
+                            <button class="btn btn-rename" onclick="renameFile('{js_key}')" title="Rename File">✏️ Rename</button>
+                            <button class="btn btn-delete" onclick="deleteFile('{js_key}')" title="Delete File">🗑️ Delete</button>
+                        </div>
+                    </td>
+                </tr>"""
+
 @routes.get('/dashboard')
 async def dashboard_handler(request):
     if not check_dashboard_auth(request):
@@ -326,45 +1880,34 @@ async def dashboard_handler(request):
             text="🔒 Access Denied"
         )
 
-    file_rows = ""
-    total_size_bytes = 0
-    total_files = 0
-    
+    q = request.query.get('q', '').strip()
+    sort = request.query.get('sort', 'date')
+    order = 'asc' if request.query.get('order') == 'asc' else 'desc'
+    try: page = max(int(request.query.get('page', 1)), 1)
+    except ValueError: page = 1
+
+    items, error = [], None
+    total_files = total_size_bytes = matched = 0
     try:
-        response = await asyncio.to_thread(sync_get_r2_files)
-        if 'Contents' in response:
-            total_files = len(response['Contents'])
-            for obj in sorted(response['Contents'], key=lambda x: x['LastModified'], reverse=True):
-                name = obj['Key']
-                size_bytes = obj['Size']
-                total_size_bytes += size_bytes
-                
-                size_str = human_size(size_bytes)
-                timestamp = obj['LastModified'].timestamp()
-                date_str = obj['LastModified'].strftime("%Y-%m-%d %H:%M")
-                url = f"{R2_PUBLIC_URL}/{quote(name, safe='/')}"
-                
-                file_rows += f"""
-                <tr>
-                    <td data-val="{name}"><span class="file-name">{name}</span></td>
-                    <td data-val="{size_bytes}">{size_str}</td>
-                    <td data-val="{timestamp}">{date_str}</td>
-                    <td>
-                        <div class="actions">
-                            <button class="btn btn-copy" onclick="copyText('{url}')" title="Copy URL">🔗 Copy</button>
-                            <a href="{url}" target="_blank" class="btn btn-view" title="Play Video">▶️ Play</a>
-                            <button class="btn btn-move" onclick="moveFolder('{quote(name)}')" title="Move to Folder">📁 Move</button>
-                            <button class="btn btn-rename" onclick="renameFile('{quote(name)}')" title="Rename File">✏️ Rename</button>
-                            <button class="btn btn-delete" onclick="deleteFile('{quote(name)}')" title="Delete File">🗑️ Delete</button>
-                        </div>
-                    </td>
-                </tr>"""
-        else:
-            file_rows = "<tr><td colspan='4' style='text-align:center; color:#94a3b8;'>No files found in your bucket.</td></tr>"
+        await r2_index.ensure_fresh()
+        total_files, total_size_bytes = r2_index.totals()
+        matched, items = r2_index.query(q=q, sort=sort, order=order, offset=(page - 1) * DASHBOARD_PAGE_SIZE)
     except Exception as e:
-        file_rows = f"<tr><td colspan='4' style='color:#fb7185;'>Error connecting to R2: {str(e)}</td></tr>"
+        error = e
+
+    def page_link(**changes):
+        params = {'q': q, 'sort': sort, 'order': order, 'page': page}
+        params.update(changes)
+        return html.escape('/dashboard?' + '&'.join(f"{k}={quote(str(v))}" for k, v in params.items() if v not in ('', None)))
 
-    html = f"""
+    def sort_header(col, label):
+        arrow = (' 🔼' if order == 'asc' else ' 🔽') if sort == col else ''
+        next_order = 'desc' if sort == col and order == 'asc' else 'asc'
+        return f'<th><a class="sort-link" href="{page_link(sort=col, order=next_order, page=1)}">{label}<span>{arrow}</span></a></th>'
+
+    resp = web.StreamResponse(headers={'Content-Type': 'text/html; charset=utf-8'})
+    await resp.prepare(request)
+    await resp.write(f"""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -382,31 +1925,84 @@ async def dashboard_handler(request):
             <div class="stats-grid">
                 <div class="stat-card"><div class="stat-title">Storage Used</div><div class="stat-val">{human_size(total_size_bytes) if total_size_bytes else '0 B'}</div></div>
                 <div class="stat-card"><div class="stat-title">Total Files</div><div class="stat-val">{total_files}</div></div>
-                <div class="stat-card"><div class="stat-title">Active Bucket</div><div class="stat-val">{R2_BUCKET_NAME}</div></div>
+                <div class="stat-card"><div class="stat-title">Active Bucket</div><div class="stat-val">{html.escape(R2_BUCKET_NAME)}</div></div>
             </div>
 
-            <div class="controls">
-                <input type="text" id="searchInput" class="search-box" onkeyup="filterTable()" placeholder="🔍 Search files by name or folder...">
+            <div class="controls bulk-bar">
+                <button class="btn btn-delete" onclick="bulkDelete()">🗑️ Delete Selected</button>
+                <button class="btn btn-move" onclick="bulkMove()">📁 Move Selected</button>
+                <button class="btn btn-delete" onclick="prefixDelete()">🧹 Delete Folder</button>
+                <button class="btn btn-move" onclick="prefixMove()">📦 Move Folder</button>
             </div>
+            <div id="bulkStatus" class="bulk-status"></div>
+
+            <form class="controls" method="get" action="/dashboard">
+                <input type="text" name="q" value="{html.escape(q)}" class="search-box" placeholder="🔍 Search files by name or folder...">
+                <input type="hidden" name="sort" value="{html.escape(sort)}"><input type="hidden" name="order" value="{order}">
+            </form>
 
             <div class="table-wrapper">
                 <table>
                     <thead>
                         <tr>
-                            <th id="th-0" onclick="sortTable(0, 'str')">File Path / Name <span></span></th>
-                            <th id="th-1" onclick="sortTable(1, 'num')">Size <span></span></th>
-                            <th id="th-2" onclick="sortTable(2, 'num')">Date Uploaded <span>🔽</span></th>
+                            <th><input type="checkbox" onclick="toggleAll(this)"></th>
+                            {sort_header('name', 'File Path / Name')}
+                            {sort_header('size', 'Size')}
+                            {sort_header('date', 'Date Uploaded')}
                             <th>Actions</th>
                         </tr>
                     </thead>
-                    <tbody>{file_rows}</tbody>
+                    <tbody>""".encode())
+
+    # Rows go out in batches so the first bytes leave before the table is built
+    batch = []
+    for name, (size_bytes, timestamp) in items:
+        batch.append(render_file_row(name, size_bytes, timestamp))
+        if len(batch) >= DASHBOARD_BATCH_ROWS:
+            await resp.write(''.join(batch).encode())
+            batch.clear()
+    if error is not None:
+        batch.append(f"<tr><td colspan='5' style='color:#fb7185;'>Error connecting to R2: {html.escape(str(error))}</td></tr>")
+    elif not items:
+        batch.append("<tr><td colspan='5' style='text-align:center; color:#94a3b8;'>No files found in your bucket.</td></tr>")
+
+    pages = max(math.ceil(matched / DASHBOARD_PAGE_SIZE), 1)
+    pager = f'<div class="pager"><span>Page {page} / {pages} · {matched} matching</span>'
+    if page > 1: pager += f'<a class="btn btn-copy" href="{page_link(page=page - 1)}">◀ Prev</a>'
+    if page < pages: pager += f'<a class="btn btn-copy" href="{page_link(page=page + 1)}">Next ▶</a>'
+    pager += '</div>'
+    batch.append(f"""</tbody>
                 </table>
             </div>
+            {pager}
         </div>
     </body>
     </html>
-    """
-    return web.Response(text=html, content_type='text/html')
+    """)
+    await resp.write(''.join(batch).encode())
+    await resp.write_eof()
+    return resp
+
+@routes.get('/api/files')
+async def api_files_handler(request):
+    if not check_dashboard_auth(request): return web.json_response({'error': 'Unauthorized'}, status=401)
+    try:
+        offset = max(int(request.query.get('offset', 0)), 0)
+        limit = min(max(int(request.query.get('limit', DASHBOARD_PAGE_SIZE)), 1), 1000)
+    except ValueError:
+        return web.json_response({'error': 'offset/limit must be integers'}, status=400)
+    try: await r2_index.ensure_fresh(force=request.query.get('refresh') == '1')
+    except Exception as e: return web.json_response({'error': f"R2 listing failed: {e}"}, status=502)
+    total, items = r2_index.query(
+        q=request.query.get('q', '').strip(), prefix=request.query.get('prefix', ''),
+        sort=request.query.get('sort', 'date'), order=request.query.get('order', 'desc'),
+        offset=offset, limit=limit
+    )
+    return web.json_response({
+        'total': total, 'offset': offset, 'limit': limit,
+        'items': [{'key': key, 'size': size, 'last_modified': mtime, 'url': f"{R2_PUBLIC_URL}/{quote(key, safe='/')}"}
+                  for key, (size, mtime) in items]
+    })
 
 @routes.get('/delete_file')
 async def web_delete_handler(request):
@@ -415,7 +2011,9 @@ async def web_delete_handler(request):
     if key:
         try: 
             await asyncio.to_thread(sync_delete_r2_file, key)
-            force_system_ram_purge()
+            r2_index.remove(key)
+            content_index.drop_s3_key(key)
+            r2_refs.drop_s3_key(key)
         except: pass
     raise web.HTTPFound('/dashboard')
 
@@ -426,7 +2024,9 @@ async def web_rename_handler(request):
     if old_key and new_key and old_key != new_key:
         try: 
             await asyncio.to_thread(sync_rename_r2_file, old_key, new_key)
-            force_system_ram_purge()
+            r2_index.rename(old_key, new_key)
+            content_index.rename_s3_key(old_key, new_key)
+            r2_refs.rename_s3_key(old_key, new_key)
         except: pass
     raise web.HTTPFound('/dashboard')
 
@@ -441,10 +2041,135 @@ async def web_move_handler(request):
         if old_key != new_key:
             try: 
                 await asyncio.to_thread(sync_rename_r2_file, old_key, new_key)
-                force_system_ram_purge()
+                r2_index.rename(old_key, new_key)
+                content_index.rename_s3_key(old_key, new_key)
+                r2_refs.rename_s3_key(old_key, new_key)
             except: pass
     raise web.HTTPFound('/dashboard')
 
+# --- 8b. BULK / PREFIX OPERATIONS ---
+bulk_tasks = OrderedDict()
+bulk_executor = ThreadPoolExecutor(max_workers=BULK_CONCURRENCY, thread_name_prefix='r2-bulk')
+
+async def run_bulk_task(task, action, items, target, prefix):
+    loop = asyncio.get_running_loop()
+    try:
+        if items is None:
+            # Prefix operations list the folder here, not in the request; the page count is the progress
+            task['phase'] = 'listing'
+            listed = await loop.run_in_executor(bulk_executor, sync_list_r2_keys, prefix, lambda n: task.update(done=n))
+            items = [(key, size) for key, size in listed if key.startswith(prefix)]
+            task['done'], task['total'] = 0, len(items)
+
+        if action == 'delete':
+            task['phase'] = 'deleting'
+            keys = [key for key, _ in items]
+            for i in range(0, len(keys), 1000):
+                batch = keys[i:i + 1000]
+                failed = await loop.run_in_executor(bulk_executor, sync_delete_r2_batch, batch)
+                for key in batch:
+                    if key in failed: continue
+                    r2_index.remove(key)
+                    content_index.drop_s3_key(key)
+                    r2_refs.drop_s3_key(key)
+                task['errors'].extend(failed)
+                task['done'] += len(batch)
+        else:
+            target = target.strip().strip('/')
+            def new_key_for(key):
+                rest = key[len(prefix):] if prefix and key.startswith(prefix) else key.split('/')[-1]
+                return f"{target}/{rest}" if target else rest
+
+            # Never let a copy land on an existing object or on another source's destination
+            # (a/f.mp4 and b/f.mp4 both -> z/f.mp4): those sources are left where they are
+            await r2_index.ensure_fresh()
+            plan = [(key, size, new_key_for(key)) for key, size in items]
+            sources = {key for key, _, _ in plan}
+            claims = {}
+            for _, _, new_key in plan: claims[new_key] = claims.get(new_key, 0) + 1
+            todo = []
+            for key, size, new_key in plan:
+                if new_key == key:
+                    task['done'] += 1
+                elif claims[new_key] > 1:
+                    task['errors'].append(f"{key}: {claims[new_key]} files would move to {new_key}")
+                    task['done'] += 1
+                elif new_key in r2_index.objects and new_key not in sources:
+                    task['errors'].append(f"{key}: {new_key} already exists")
+                    task['done'] += 1
+                else:
+                    todo.append((key, size, new_key))
+
+            task['phase'] = 'copying'
+            moved = []
+            async def copy_one(key, size, new_key):
+                try:
+                    await loop.run_in_executor(bulk_executor, sync_copy_r2_object, key, new_key, size)
+                    moved.append(key)
+                    r2_index.add(new_key, size)
+                    content_index.rename_s3_key(key, new_key)
+                    r2_refs.rename_s3_key(key, new_key)
+                except Exception:
+                    task['errors'].append(key)
+                task['done'] += 1
+            # The executor caps concurrency; copies are server-side, no bytes pass through us
+            await asyncio.gather(*(copy_one(*entry) for entry in todo))
+            task['phase'] = 'deleting'
+            for i in range(0, len(moved), 1000):
+                batch = moved[i:i + 1000]
+                failed = await loop.run_in_executor(bulk_executor, sync_delete_r2_batch, batch)
+                for key in batch:
+                    if key in failed: task['errors'].append(f"{key}: copied, but the original could not be deleted")
+                    else: r2_index.remove(key)
+        task['state'] = task['phase'] = 'done'
+    except Exception as e:
+        task['state'], task['error'] = 'failed', str(e)
+    finally:
+        task['finished'] = time.time()
+
+@routes.post('/api/bulk')
+async def api_bulk_handler(request):
+    if not check_dashboard_auth(request): return web.json_response({'error': 'Unauthorized'}, status=401)
+    try: body = await request.json()
+    except Exception: return web.json_response({'error': 'Invalid JSON body'}, status=400)
+    action, keys = body.get('action'), body.get('keys') or []
+    # A folder is always "<name>/": a bare "2026/1/1" must not also match 2026/1/10/ .. 2026/1/19/
+    prefix = (body.get('prefix') or '').strip().strip('/')
+    prefix = f"{prefix}/" if prefix else ''
+    if action not in ('delete', 'move'): return web.json_response({'error': 'action must be delete or move'}, status=400)
+    if action == 'move' and body.get('target') is None: return web.json_response({'error': 'move needs a target folder'}, status=400)
+    if not keys and not prefix: return web.json_response({'error': 'Select files or give a prefix'}, status=400)
+
+    items = None
+    if not prefix:
+        await r2_index.ensure_fresh()
+        items = [(key, r2_index.objects.get(key, (0, 0))[0]) for key in dict.fromkeys(keys)]
+
+    # Forget finished tasks after an hour so the registry stays small
+    for task_id in [t for t, v in bulk_tasks.items() if v.get('finished') and time.time() - v['finished'] > 3600]:
+        del bulk_tasks[task_id]
+    task_id = secrets.token_hex(6)
+    task = bulk_tasks[task_id] = {'action': action, 'state': 'running', 'phase': 'starting', 'done': 0,
+                                  'total': len(items) if items is not None else None, 'errors': []}
+    asyncio.create_task(run_bulk_task(task, action, items, body.get('target') or '', prefix))
+    return web.json_response({'task_id': task_id, 'total': task['total']})
+
+@routes.get('/api/bulk/{task_id}')
+async def api_bulk_status_handler(request):
+    if not check_dashboard_auth(request): return web.json_response({'error': 'Unauthorized'}, status=401)
+    task = bulk_tasks.get(request.match_info['task_id'])
+    if not task: return web.json_response({'error': 'Unknown task'}, status=404)
+    return web.json_response(task)
+
+@routes.get('/metrics')
+async def metrics_handler(request):
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip() or request.query.get('token', '')
+    allowed = secrets.compare_digest(token, METRICS_TOKEN) if METRICS_TOKEN else check_dashboard_auth(request)
+    if not allowed:
+        return web.Response(status=401, headers={'WWW-Authenticate': 'Basic realm="metrics"'}, text="Unauthorized")
+    workers = await fetch_worker_metrics() if MULTI_PROCESS else ()
+    return web.Response(text=render_metrics(workers), content_type='text/plain', headers={'X-Content-Type-Options': 'nosniff'})
+
 @routes.get('/')
 async def root(request):
     html = """
@@ -455,76 +2180,707 @@ async def root(request):
     """
     return web.Response(text=html, content_type='text/html')
 
+def parse_range_header(range_header, size):
+    """Returns an inclusive (start, end), None to serve the whole file, or raises ValueError (416)."""
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', range_header or '')
+    if not match or not (match.group(1) or match.group(2)): return None
+    first, last = match.group(1), match.group(2)
+    if size <= 0: raise ValueError("Empty file")
+    if not first:
+        suffix = int(last)
+        if suffix == 0: raise ValueError("Empty suffix range")
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    if start >= size: raise ValueError("Range starts past EOF")
+    end = min(int(last), size - 1) if last else size - 1
+    if end < start: return None
+    return start, end
+
+async def refresh_tg_link(code, record):
+    tg_msg = await client.get_messages(record['chat_id'], ids=record['msg_id'])
+    if not tg_msg or not tg_msg.file: raise FileNotFoundError("Source message is gone")
+    record = tg_link_record(tg_msg, record['name'])
+    link_store.update(code, record)
+    return record
+
+R2_PROXY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'ETag', 'Last-Modified')
+
+async def r2_proxy(request, s3_key, file_name):
+    # Private bucket without redirects: relay the object (and any Range) over the pooled session
+    fwd = {h: request.headers[h] for h in ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since') if h in request.headers}
+    async with get_http_session().request(request.method, get_presigned_url(s3_key, request.method), headers=fwd) as upstream:
+        if upstream.status >= 400 and upstream.status != 416:
+            return web.Response(text="Not found" if upstream.status == 404 else "Upstream error", status=404 if upstream.status == 404 else 502)
+        headers = {h: upstream.headers[h] for h in R2_PROXY_HEADERS if h in upstream.headers}
+        headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        resp = web.StreamResponse(status=upstream.status, headers=headers)
+        await resp.prepare(request)
+        if request.method == 'HEAD': return resp
+        ACTIVE_STREAMS.inc()
+        try:
+            async for chunk in upstream.content.iter_chunked(256 * 1024):
+                await resp.write(chunk)
+                TRANSFER_BYTES.inc(len(chunk), stage='stream_out')
+        except: pass
+        finally: ACTIVE_STREAMS.dec()
+        return resp
+
 @routes.get('/{code}/{filename}')
 async def stream_handler(request):
     code = request.match_info['code']
-    data = link_storage.get(code)
-    if not data: return web.Response(text="Expired", status=410)
-    msg, file_name = data['msg'], unquote(request.match_info['filename'])
-    range_header = request.headers.get('Range')
-    start = 0
-    if range_header:
-        match = re.search(r'bytes=(\d+)-', range_header)
-        if match: start = int(match.group(1))
-    resp = web.StreamResponse(status=206 if range_header else 200, 
-                              headers={'Content-Disposition': f'attachment; filename="{file_name}"',
-                                       'Accept-Ranges': 'bytes', 'Content-Type': 'video/mp4',
-                                       'Content-Length': str(msg.file.size - start)})
-    await resp.prepare(request)
+    data = link_store.get(code) or r2_refs.get(code)
+    if data and 's3_key' in data:
+        if R2_LINK_MODE == 'proxy':
+            return await r2_proxy(request, data['s3_key'], unquote(request.match_info['filename']))
+        # The bytes come straight from R2, never through this container
+        raise web.HTTPFound(get_presigned_url(data['s3_key'], request.method), headers={'Cache-Control': 'no-store'})
+    if not data or 'dc_id' not in data: return web.Response(text="Expired", status=410)
+    file_name = unquote(request.match_info['filename'])
+    size = data['size']
+    headers = {'Content-Disposition': f'attachment; filename="{file_name}"',
+               'Accept-Ranges': 'bytes', 'Content-Type': data['mime'] or 'video/mp4'}
+    try:
+        byte_range = parse_range_header(request.headers.get('Range'), size)
+    except ValueError:
+        return web.Response(status=416, headers={'Content-Range': f'bytes */{size}', 'Accept-Ranges': 'bytes'})
+    if byte_range:
+        (start, end), status = byte_range, 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        start, end, status = 0, size - 1, 200
+    headers['Content-Length'] = str(end - start + 1)
+
+    resp = web.StreamResponse(status=status, headers=headers)
+    if request.method == 'HEAD':
+        await resp.prepare(request)
+        return resp
+
+    cache_key = f"{data['kind']}{data['id']}" if tg_cache else None
+    if cache_key and tg_cache.has_range(cache_key, start, end):
+        # Every byte is on local disk: zero-copy sendfile, no Telegram traffic at all
+        TRANSFER_BYTES.inc(end - start + 1, stage='stream_out_sendfile')
+        return CachedFileResponse(cache_key, headers={k: headers[k] for k in ('Content-Disposition', 'Content-Type')})
+
+    # Each reader holds a prefetch window of chunks in RAM; past the budget, turn it away rather than OOM
+    try: lease = await governor.acquire(TG_DOWNLOAD_WORKERS * TG_CHUNK_SIZE, 'stream', timeout=MEMORY_STREAM_WAIT)
+    except asyncio.TimeoutError: return web.Response(text="Busy, retry shortly", status=503, headers={'Retry-After': '10'})
     try:
-        async for chunk in client.iter_download(msg.media, offset=(start//1048576)*1048576, request_size=1048576):
-            await resp.write(chunk)
-    except: pass
+        # Pull the first chunk before committing to a status so a stale file_reference can be refreshed
+        chunks = tg_download(tg_record_location(data), size, offset=start, limit=end - start + 1, cache_key=cache_key)
+        try:
+            first_chunk = await anext(chunks, b'')
+        except errors.FileReferenceExpiredError:
+            try: data = await refresh_tg_link(code, data)
+            except Exception: return web.Response(text="Expired", status=410)
+            chunks = tg_download(tg_record_location(data), size, offset=start, limit=end - start + 1, cache_key=cache_key)
+            first_chunk = await anext(chunks, b'')
+        await resp.prepare(request)
+        ACTIVE_STREAMS.inc()
+        try:
+            await resp.write(first_chunk)
+            async for chunk in chunks:
+                await resp.write(chunk)
+                TRANSFER_BYTES.inc(len(chunk), stage='stream_out')
+        except: pass
+        finally:
+            ACTIVE_STREAMS.dec()
+            await chunks.aclose()
+    finally:
+        lease.release()
     return resp
 
 # --- 9. TG FAST UPLOAD ---
 async def fast_upload(client, file_path, msg, filename):
     file_size = os.path.getsize(file_path)
     part_size, file_id = 512 * 1024, random.getrandbits(63)
-    start_time, uploaded_bytes = time.time(), 0
-    sem = asyncio.Semaphore(15) 
-    async def upload_part(idx):
-        nonlocal uploaded_bytes
-        async with sem:
-            with open(file_path, 'rb') as f:
-                f.seek(idx * part_size); chunk = f.read(part_size)
-            if file_size > 10*1024*1024: await client(SaveBigFilePartRequest(file_id, idx, math.ceil(file_size/part_size), chunk))
-            else: await client(SaveFilePartRequest(file_id, idx, chunk))
-            uploaded_bytes += len(chunk)
-    tasks = [upload_part(i) for i in range(math.ceil(file_size/part_size))]
-    async def updater():
-        while uploaded_bytes < file_size:
-            await asyncio.sleep(4)
-            try: await msg.edit(get_status_text("Uploading to TG", filename, uploaded_bytes, file_size, start_time))
-            except: pass
-    u_task = asyncio.create_task(updater())
-    await asyncio.gather(*tasks); u_task.cancel()
-    return InputFileBig(file_id, math.ceil(file_size/part_size), filename) if file_size > 10*1024*1024 else InputFile(file_id, math.ceil(file_size/part_size), filename, '')
+    total_parts = max(math.ceil(file_size / part_size), 1)
+    is_big = file_size > 10*1024*1024
+
+    # AIMD window: grow while RTT stays near its best, halve on FloodWait/timeouts
+    limit, base_rtt = float(min(8, TG_UPLOAD_MAX_WORKERS)), None
+    queue, in_flight, attempts = deque(range(total_parts)), {}, {}
+
+    async def upload_part(mm, idx):
+        # Slicing the mmap reads straight from the page cache; no per-part open/seek
+        chunk = mm[idx * part_size:(idx + 1) * part_size] if file_size else b''
+        t0 = time.monotonic()
+        if is_big: await client(SaveBigFilePartRequest(file_id, idx, total_parts, chunk), flood_sleep_threshold=0)
+        else: await client(SaveFilePartRequest(file_id, idx, chunk), flood_sleep_threshold=0)
+        return len(chunk), time.monotonic() - t0
+
+    with open(file_path, 'rb') as f, (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else open(os.devnull, 'rb')) as mm:
+        async with progress_hub.track(msg, "Uploading to TG", filename, file_size) as progress:
+            try:
+                while queue or in_flight:
+                    while queue and len(in_flight) < int(limit):
+                        idx = queue.popleft()
+                        in_flight[asyncio.create_task(upload_part(mm, idx))] = idx
+                    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        idx = in_flight.pop(task)
+                        exc = task.exception()
+                        if exc is None:
+                            sent, rtt = task.result()
+                            TG_UPLOAD_PART.observe(rtt)
+                            TRANSFER_BYTES.inc(sent, stage='tg_upload')
+                            progress.add(sent)
+                            base_rtt = rtt if base_rtt is None else min(base_rtt, rtt)
+                            if rtt < base_rtt * 2: limit = min(limit + 1 / limit, TG_UPLOAD_MAX_WORKERS)
+                            continue
+                        if not isinstance(exc, (errors.FloodWaitError, ConnectionError, asyncio.TimeoutError, errors.ServerError, errors.TimedOutError)):
+                            raise exc
+                        TG_UPLOAD_RETRIES.inc(error=type(exc).__name__)
+                        attempts[idx] = attempts.get(idx, 0) + 1
+                        if attempts[idx] > TG_UPLOAD_PART_RETRIES: raise exc
+                        limit = max(limit / 2, TG_UPLOAD_MIN_WORKERS)
+                        if isinstance(exc, errors.FloodWaitError): await asyncio.sleep(exc.seconds)
+                        # Only the failed part is sent again
+                        queue.appendleft(idx)
+            finally:
+                for task in in_flight: task.cancel()
+                if in_flight: await asyncio.wait(in_flight)
+    return InputFileBig(file_id, total_parts, filename) if is_big else InputFile(file_id, total_parts, filename, '')
+
+# --- 9b. WRITE-BEHIND FILE SINK ---
+# Download loops hand chunks to a per-file writer thread instead of calling f.write() on the event loop.
+# The queue is bounded in bytes, so a slow disk backs up into the network reader rather than into RSS.
+class FileSink:
+    def __init__(self, path, length=0):
+        # The file is cut/extended to `length` first; appends continue from there
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, length)
+        self.pos = self.written = length
+        self.pending, self.error, self.closed = 0, None, False
+        self.loop = asyncio.get_running_loop()
+        self.space = asyncio.Event()
+        self.items = SimpleQueue()
+        self.lease = current_lease.get()
+        threading.Thread(target=self._run, daemon=True, name=f"sink-{os.path.basename(path)[:20]}").start()
+
+    async def write(self, data, pos=None):
+        # pos=None appends; segmented downloads pass explicit offsets
+        if self.error: raise self.error
+        if not data: return
+        if pos is None: pos, self.pos = self.pos, self.pos + len(data)
+        if self.pending and self.pending + len(data) > FILE_SINK_BUFFER:
+            FILE_SINK_STALLS.inc()
+            while self.pending and self.pending + len(data) > FILE_SINK_BUFFER and not self.error:
+                self.space.clear()
+                await self.space.wait()
+            if self.error: raise self.error
+        self.pending += len(data)
+        if self.lease: self.lease.add(len(data))
+        self.items.put((pos, data))
+
+    async def barrier(self):
+        # Returns once everything queued so far has been handed to the OS (survives a process kill)
+        await self._control('barrier')
+
+    async def close(self):
+        # The only fsync of the file, run on the writer thread
+        if self.closed: return
+        self.closed = True
+        await self._control('fsync')
+
+    def abort(self):
+        # Error path: drop anything still queued and close without syncing
+        if self.closed: return
+        self.closed = True
+        self.error = self.error or ConnectionAbortedError("File sink aborted")
+        self.items.put(('close', None))
+
+    async def _control(self, action):
+        fut = self.loop.create_future()
+        self.items.put((action, fut))
+        await fut
+        if self.error: raise self.error
+
+    async def __aenter__(self): return self
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type: self.abort()
+        else: await self.close()
+
+    def _notify(self, fn, *args):
+        try: self.loop.call_soon_threadsafe(fn, *args)
+        except RuntimeError: pass
+
+    def _released(self, n, end):
+        self.pending -= n
+        if self.lease: self.lease.add(-n)
+        self.written = max(self.written, end)
+        self.space.set()
+
+    def _resolve(self, fut):
+        if fut and not fut.done(): fut.set_result(None)
+
+    def _pwritev(self, pos, bufs):
+        t0 = time.perf_counter()
+        views = [memoryview(b) for b in bufs]
+        while views:
+            n = os.pwritev(self.fd, views, pos)
+            pos += n
+            while views and n >= len(views[0]): n -= len(views.pop(0))
+            if views and n: views[0] = views[0][n:]
+        FILE_SINK_WRITE.observe(time.perf_counter() - t0)
+
+    def _run(self):
+        run_pos, run, run_len = None, [], 0
+        def flush():
+            nonlocal run_pos, run, run_len
+            if not run: return
+            try:
+                if not self.error: self._pwritev(run_pos, run)
+            except Exception as e: self.error = e
+            self._notify(self._released, run_len, run_pos + run_len)
+            run_pos, run, run_len = None, [], 0
+
+        while True:
+            item = self.items.get()
+            batch = [item]
+            # Whatever else is already queued goes out with it, adjacent chunks as a single pwritev
+            while len(batch) < 256:
+                try: batch.append(self.items.get_nowait())
+                except Empty: break
+            for pos, data in batch:
+                if isinstance(pos, str):
+                    flush()
+                    if pos != 'barrier':
+                        try:
+                            if pos == 'fsync' and not self.error: os.fsync(self.fd)
+                        except Exception as e: self.error = e
+                        finally: os.close(self.fd)
+                        self._notify(self._resolve, data)
+                        return
+                    self._notify(self._resolve, data)
+                    continue
+                if run and (pos != run_pos + run_len or run_len >= FILE_SINK_COALESCE or len(run) >= 64): flush()
+                if not run: run_pos = pos
+                run.append(data)
+                run_len += len(data)
+            flush()
 
 # --- 10. HYBRID DOWNLOADER ---
-async def download_any_url(url, custom_name, msg, start_t):
+http_session = None
+
+def get_http_session():
+    # One pooled session for every direct leech instead of a new one per call
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        )
+    return http_session
+
+def direct_filename(url, custom_name):
+    filename = custom_name or unquote(url.split("/")[-1].split("?")[0]) or "video.mp4"
+    if not "." in filename: filename += ".mp4"
+    return get_unique_filename(re.sub(r'[\\/*?:"<>|]', "", clean_double_extension(filename)))
+
+async def segmented_download(sess, url, filename, size, progress, checkpoint=None):
+    # Pieces finished before a restart are skipped, if the file and piece layout are unchanged
+    done = set()
+    if checkpoint and checkpoint.data.get('piece_size') == DIRECT_PIECE_SIZE and os.path.exists(filename) and os.path.getsize(filename) == size:
+        done = set(checkpoint.data.get('pieces', []))
+    if checkpoint: checkpoint.update(piece_size=DIRECT_PIECE_SIZE, pieces=sorted(done))
+    progress.add(sum(min(DIRECT_PIECE_SIZE, size - start) for start in done))
+    # Fixed-size pieces pulled by N workers, so one slow connection can't stall the tail
+    pieces = deque((start, min(start + DIRECT_PIECE_SIZE, size) - 1) for start in range(0, size, DIRECT_PIECE_SIZE) if start not in done)
+    sink = FileSink(filename, size)
+
+    async def worker():
+        while pieces:
+            start, end = pieces.popleft()
+            pos = start
+            for attempt in range(5):
+                try:
+                    async with sess.get(url, headers={'Range': f'bytes={pos}-{end}'}) as r:
+                        if r.status != 206: raise ValueError("Server stopped honouring Range requests.")
+                        async for chunk in r.content.iter_chunked(1024*1024):
+                            await sink.write(chunk, pos)
+                            pos += len(chunk)
+                            progress.add(len(chunk))
+                            TRANSFER_BYTES.inc(len(chunk), stage='direct_download')
+                    if pos > end:
+                        if checkpoint:
+                            # Only record the piece once its bytes have left the write-behind queue
+                            await sink.barrier()
+                            done.add(start)
+                            checkpoint.update(throttle=True, pieces=sorted(done))
+                        break
+                    raise ConnectionError(f"Short read at byte {pos}")
+                except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError):
+                    # Resume the piece where it stopped instead of refetching it
+                    if attempt == 4: raise
+                    await asyncio.sleep(1 + attempt)
+
+    workers = [asyncio.create_task(worker()) for _ in range(max(DIRECT_CONNECTIONS, 1))]
+    try:
+        await asyncio.gather(*workers)
+        await sink.close()
+    finally:
+        for w in workers: w.cancel()
+        sink.abort()
+
+ARIA2_PROGRESS = re.compile(r'\[#\w+\s+([\d.]+)([KMG]?i?B)/')
+ARIA2_UNITS = {'B': 1, 'KiB': 1024, 'MiB': 1024**2, 'GiB': 1024**3}
+
+async def aria2_download(url, filename, progress):
+    n = str(max(DIRECT_CONNECTIONS, 1))
+    proc = await asyncio.create_subprocess_exec(
+        'aria2c', '-x', n, '-s', n, '-k', '1M', '--file-allocation=none', '--allow-overwrite=true',
+        '--auto-file-renaming=false', '--summary-interval=1', '--console-log-level=warn',
+        '-d', os.path.dirname(os.path.abspath(filename)), '-o', os.path.basename(filename), url,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
     try:
-        await msg.edit("🅿️ **Extracting File Info via yt-dlp...**")
-        filename = await asyncio.to_thread(sync_yt_dlp_download, url, custom_name)
-        if filename and os.path.exists(filename) and os.path.getsize(filename) > 0:
+        tail = b''
+        while True:
+            data = await proc.stdout.read(4096)
+            if not data: break
+            *lines, tail = re.split(rb'[\r\n]', tail + data)
+            for line in lines:
+                match = ARIA2_PROGRESS.search(line.decode(errors='ignore'))
+                if match: progress.set(int(float(match.group(1)) * ARIA2_UNITS.get(match.group(2), 1)))
+        if await proc.wait() != 0: raise RuntimeError(f"aria2c failed with exit code {proc.returncode}")
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+async def download_any_url(url, custom_name, msg, checkpoint=None, use_ytdlp=None):
+    resumed = checkpoint.data.get('filename') if checkpoint else None
+    if resumed and checkpoint.data.get('downloaded') and os.path.exists(resumed): return resumed
+    if use_ytdlp is None: use_ytdlp = await should_try_yt_dlp(url)
+    if use_ytdlp:
+        try:
+            await msg.edit("🅿️ **Extracting File Info via yt-dlp...**")
+            async with progress_hub.track(msg, "yt-dlp Downloading", custom_name or url, 0) as progress:
+                filename = await yt_dlp_download(url, custom_name, on_progress=progress.set)
+            if filename and os.path.exists(filename) and os.path.getsize(filename) > 0:
+                return filename
+        except Exception: pass
+
+    sess = get_http_session()
+    # A one-byte Range probe tells us the real size and whether segmenting is possible
+    async with sess.get(url, allow_redirects=True, headers={'Range': 'bytes=0-0'}) as r:
+        if "text/html" in r.headers.get("Content-Type", ""): raise ValueError("HTML webpage detected, not a file.")
+        content_range = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get("Content-Range", ""))
+        if r.status == 206 and content_range:
+            f_size, final_url = int(content_range.group(1)), str(r.url)
+        else:
+            f_size, final_url = 0, None
+    filename = resumed if resumed and os.path.exists(resumed) else direct_filename(url, custom_name)
+    if checkpoint: checkpoint.update(filename=filename)
+
+    try:
+        if final_url and f_size >= DIRECT_SEGMENT_MIN:
+            use_aria2 = DIRECT_ENGINE == 'aria2' and shutil.which('aria2c')
+            await msg.edit(f"⬇️ **Leeching Direct Link ({DIRECT_CONNECTIONS} connections)...**\n🎬 `{filename}`")
+            buffers = MEMORY_CHILD_ESTIMATE if use_aria2 else FILE_SINK_BUFFER + DIRECT_CONNECTIONS * 1024 * 1024
+            async with governor.lease(buffers, 'direct_download'), progress_hub.track(msg, "Leeching", filename, f_size) as progress:
+                if use_aria2: await aria2_download(final_url, filename, progress)
+                else: await segmented_download(sess, final_url, filename, f_size, progress, checkpoint)
             return filename
-    except Exception: pass
 
-    async with ClientSession() as sess:
         async with sess.get(url, allow_redirects=True) as r:
             if "text/html" in r.headers.get("Content-Type", ""): raise ValueError("HTML webpage detected, not a file.")
             f_size = int(r.headers.get("Content-Length", 0))
-            filename = custom_name or unquote(url.split("/")[-1].split("?")[0]) or "video.mp4"
-            if not "." in filename: filename += ".mp4"
-            filename = get_unique_filename(re.sub(r'[\\/*?:"<>|]', "", clean_double_extension(filename)))
 
             await msg.edit(f"⬇️ **Leeching Direct Link...**\n🎬 `{filename}`")
-            with open(filename, 'wb') as f:
-                async for chunk in r.content.iter_chunked(1024*1024):
-                    f.write(chunk)
-                    if f.tell() % (10 * 1024 * 1024) == 0:
-                        await msg.edit(get_status_text("Leeching", filename, f.tell(), f_size, start_t))
+            async with governor.lease(FILE_SINK_BUFFER + 1024 * 1024, 'direct_download'), progress_hub.track(msg, "Leeching", filename, f_size) as progress:
+                async with FileSink(filename) as sink:
+                    async for chunk in r.content.iter_chunked(1024*1024):
+                        await sink.write(chunk)
+                        progress.add(len(chunk))
+                        TRANSFER_BYTES.inc(len(chunk), stage='direct_download')
             return filename
+    except BaseException:
+        if os.path.exists(filename): os.remove(filename)
+        raise
+
+# --- 10b. FASTSTART REMUX ---
+def mp4_needs_faststart(path):
+    """True when a top-level 'mdat' box comes before 'moov', i.e. players must fetch the tail first."""
+    try:
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            pos, first = 0, True
+            while pos + 8 <= file_size:
+                f.seek(pos)
+                size, box = int.from_bytes(f.read(4), 'big'), f.read(4)
+                if first and box != b'ftyp': return False
+                first = False
+                if box == b'moov': return False
+                if box == b'mdat': return True
+                if size == 1: size = int.from_bytes(f.read(8), 'big')
+                elif size == 0: return False
+                if size < 8: return False
+                pos += size
+    except OSError: pass
+    return False
+
+async def wants_faststart(filename):
+    # Checked before queueing for a transcode slot, so files that are fine never wait behind a remux
+    if not FASTSTART_ENABLED or not shutil.which('ffmpeg'): return False
+    if os.path.splitext(filename)[1].lower() not in ('.mp4', '.m4v', '.mov'): return False
+    return await asyncio.to_thread(mp4_needs_faststart, filename)
+
+async def faststart_remux(filename, msg):
+    await msg.edit(f"🎞️ **Optimizing for streaming (faststart)...**\n🎬 `{os.path.basename(filename)}`")
+    # ffmpeg is a child process, but it still counts against the container's memory
+    async with governor.lease(MEMORY_CHILD_ESTIMATE, 'ffmpeg'):
+        tmp = f"{filename}.faststart{os.path.splitext(filename)[1]}"
+        t0, result = time.monotonic(), 'error'
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', filename,
+            '-map', '0', '-c', 'copy', '-movflags', '+faststart', tmp,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            await asyncio.wait_for(proc.wait(), FASTSTART_TIMEOUT)
+            # A failed remux is not fatal: the original file is still uploadable
+            if proc.returncode == 0 and os.path.getsize(tmp) > 0:
+                os.replace(tmp, filename)
+                result = 'ok'
+        except asyncio.TimeoutError:
+            result = 'timeout'
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if os.path.exists(tmp): os.remove(tmp)
+            FASTSTART_RUNS.observe(time.monotonic() - t0, result=result)
+
+# --- 10c. HLS PACKAGING ---
+HLS_COPY_ARGS = ['-c', 'copy']
+HLS_ENCODE_ARGS = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '21', '-c:a', 'aac', '-b:a', '160k']
+
+def sync_r2_put_file(path, s3_key, content_type, cache_control):
+    with open(path, 'rb') as f:
+        get_r2_client().put_object(Bucket=R2_BUCKET_NAME, Key=s3_key, Body=f, ContentType=content_type, CacheControl=cache_control)
+
+async def hls_segment_and_upload(filename, prefix, out_dir, codec_args, progress):
+    """Runs ffmpeg's HLS muxer and uploads each segment as soon as ffmpeg has moved past it."""
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', os.path.abspath(filename),
+        '-map', '0:v:0', '-map', '0:a?', *codec_args,
+        '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SEC), '-hls_playlist_type', 'vod',
+        '-hls_segment_filename', 'seg_%05d.ts', 'index.m3u8',
+        cwd=out_dir, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    queue, uploaded, failures = asyncio.Queue(), [], []
+
+    async def uploader():
+        while True:
+            name = await queue.get()
+            if name is None: return
+            if failures: continue
+            path = os.path.join(out_dir, name)
+            try:
+                size = os.path.getsize(path)
+                await asyncio.to_thread(sync_r2_put_file, path, f"{prefix}{name}", 'video/mp2t', 'public, max-age=31536000, immutable')
+                os.remove(path)
+                uploaded.append((f"{prefix}{name}", size))
+                progress.add(size)
+                TRANSFER_BYTES.inc(size, stage='r2_upload')
+            except Exception as e:
+                failures.append(e)
+
+    workers = [asyncio.create_task(uploader()) for _ in range(max(HLS_UPLOAD_WORKERS, 1))]
+    queued = set()
+    def enqueue_ready(finished):
+        segments = sorted(n for n in os.listdir(out_dir) if n.startswith('seg_') and n.endswith('.ts'))
+        # ffmpeg writes segments in order: all but the newest are complete until it exits
+        for name in segments if finished else segments[:-1]:
+            if name not in queued:
+                queued.add(name)
+                queue.put_nowait(name)
+    try:
+        deadline = time.monotonic() + HLS_TIMEOUT
+        while proc.returncode is None:
+            try: await asyncio.wait_for(proc.wait(), 0.5)
+            except asyncio.TimeoutError: pass
+            if time.monotonic() > deadline: raise asyncio.TimeoutError("HLS packaging timed out")
+            if failures: raise failures[0]
+            enqueue_ready(False)
+        if proc.returncode != 0: raise RuntimeError(f"ffmpeg exited with {proc.returncode}")
+        enqueue_ready(True)
+        for _ in workers: queue.put_nowait(None)
+        await asyncio.gather(*workers)
+        if failures: raise failures[0]
+    finally:
+        for w in workers: w.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    return uploaded
+
+async def package_hls_to_r2(filename, status_msg):
+    """Segments `filename` into HLS under its own R2 prefix and returns (playlist url, code)."""
+    if not shutil.which('ffmpeg'): raise RuntimeError("ffmpeg is not installed")
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    prefix = make_r2_key(f"{stem}/")
+    await status_msg.edit(f"📺 **Packaging HLS & uploading to R2...**\n🎬 `{os.path.basename(filename)}`")
+
+    out_dir = f"{filename}.hls"
+    try:
+        async with governor.lease(MEMORY_CHILD_ESTIMATE, 'ffmpeg'), progress_hub.track(status_msg, "HLS → R2", os.path.basename(filename), os.path.getsize(filename)) as progress:
+            # Stream copy first; re-encode only if the source codecs can't go into MPEG-TS as-is
+            for mode, codec_args in (('copy', HLS_COPY_ARGS), ('encode', HLS_ENCODE_ARGS)):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                os.makedirs(out_dir)
+                t0 = time.monotonic()
+                try:
+                    uploaded = await hls_segment_and_upload(filename, prefix, out_dir, codec_args, progress)
+                except RuntimeError:
+                    HLS_RUNS.observe(time.monotonic() - t0, mode=mode, result='error')
+                    if mode == 'encode': raise
+                    stale = await asyncio.to_thread(sync_list_r2_keys, prefix)
+                    if stale: await asyncio.to_thread(sync_delete_r2_batch, [k for k, _ in stale])
+                    progress.set(0)
+                    continue
+                HLS_RUNS.observe(time.monotonic() - t0, mode=mode, result='ok')
+                break
+
+            # The playlist goes up last, so it never points at a segment that isn't there yet
+            playlist_key, playlist_path = f"{prefix}index.m3u8", os.path.join(out_dir, 'index.m3u8')
+            await asyncio.to_thread(sync_r2_put_file, playlist_path, playlist_key, 'application/vnd.apple.mpegurl', 'public, max-age=300')
+            uploaded.append((playlist_key, os.path.getsize(playlist_path)))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    for key, size in uploaded: r2_index.add(key, size)
+    code = r2_refs.ref(playlist_key, hls_prefix=prefix)
+    return f"{R2_PUBLIC_URL}/{quote(playlist_key, safe='/')}", code
+
+# --- 10d. BATCH / PLAYLIST INGESTION ---
+URL_PATTERN = re.compile(r'https?://\S+')
+
+def parse_urls(text):
+    seen = OrderedDict((u.rstrip('.,;)>]\'"'), None) for u in URL_PATTERN.findall(text))
+    return list(seen)[:BATCH_MAX_ITEMS]
+
+class BatchStatus:
+    """One Telegram message for a whole batch: a header plus a download lane and an upload lane."""
+    def __init__(self, msg, total, job):
+        self.msg, self.total, self.job = msg, total, job
+        self.lanes = {'download': '', 'upload': ''}
+        self.done = self.failed = 0
+        self.last_edit, self.pending = 0, None
+
+    def text(self):
+        head = f"📦 **Batch** `{self.job.id}` · {self.done + self.failed}/{self.total} finished"
+        if self.failed: head += f" · ❌ {self.failed} failed"
+        return "\n\n".join([head] + [t for t in self.lanes.values() if t])
+
+    async def refresh(self):
+        # Both lanes report at once; merge them into at most one edit per PROGRESS_INTERVAL
+        if self.pending: return
+        wait = self.last_edit + PROGRESS_INTERVAL - time.monotonic()
+        if wait > 0: self.pending = asyncio.create_task(self._flush_later(wait))
+        else: await self._flush()
+
+    async def _flush_later(self, wait):
+        await asyncio.sleep(wait)
+        self.pending = None
+        await self._flush()
+
+    async def _flush(self):
+        self.last_edit = time.monotonic()
+        try: await self.msg.edit(self.text(), buttons=[[Button.inline("❌ Cancel", data=f"cancel_{self.job.id}")]])
+        except Exception: pass
+
+class BatchLane:
+    """Stands in for a status message, so download_any_url/upload_to_r2 work unchanged inside a batch."""
+    def __init__(self, batch, name):
+        self.batch, self.name = batch, name
+
+    async def edit(self, text, **kwargs):
+        self.batch.lanes[self.name] = text
+        await self.batch.refresh()
+
+async def run_batch_job(job, urls, msg, checkpoint=None):
+    # The URL list and every finished item are journalled, so a restart re-queues only what is left
+    checkpoint = checkpoint or checkpoints.open('batch', urls=urls, results={}, priority=job.priority)
+    batch = BatchStatus(msg, len(urls), job)
+    results = [None] * len(urls)
+    for i, row in checkpoint.data['results'].items(): results[int(i)] = row
+    batch.done = sum(1 for r in results if r and r[0] == '✅')
+    batch.failed = sum(1 for r in results if r and r[0] != '✅')
+
+    def finish(i, row):
+        results[i] = row
+        if row[0] == '✅': batch.done += 1
+        else: batch.failed += 1
+        checkpoint.data['results'][str(i)] = row
+        checkpoint.update()
+    # maxsize=1: item N+1 downloads while N uploads, and at most one finished file waits on disk
+    ready, files = asyncio.Queue(maxsize=1), set()
+
+    async def downloader():
+        lane = BatchLane(batch, 'download')
+        for i, url in enumerate(urls):
+            if results[i]: continue
+            try:
+                async with scheduler.stage(job, 'download'):
+                    filename = await download_any_url(url, None, lane)
+                    files.add(filename)
+                    content_key = await asyncio.to_thread(file_content_key, filename) if DEDUP_ENABLED else None
+            except Exception as e:
+                finish(i, ('❌', url, str(e)))
+                continue
+            await ready.put((i, filename, content_key))
+        batch.lanes['download'] = ''
+        await ready.put(None)
+
+    async def uploader():
+        lane = BatchLane(batch, 'upload')
+        while (item := await ready.get()) is not None:
+            i, filename, content_key = item
+            try:
+                existing = await find_duplicate(content_key)
+                if existing:
+                    r2_url = r2_public_url(existing)
+                else:
+                    if await wants_faststart(filename):
+                        async with scheduler.stage(job, 'transcode'):
+                            await faststart_remux(filename, lane)
+                    async with scheduler.stage(job, 'upload'):
+                        r2_url = await upload_to_r2(filename, lane, content_keys=[content_key], register=False)
+                finish(i, ('✅', os.path.basename(filename), r2_url))
+            except Exception as e:
+                finish(i, ('❌', os.path.basename(filename), str(e)))
+            finally:
+                if os.path.exists(filename): os.remove(filename)
+                files.discard(filename)
+            batch.lanes['upload'] = ''
+            await batch.refresh()
+
+    tasks = [asyncio.create_task(downloader()), asyncio.create_task(uploader())]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks: t.cancel()
+        checkpoint.drop()
+        if batch.pending: batch.pending.cancel()
+        for filename in files:
+            if os.path.exists(filename): os.remove(filename)
+
+    # Summary of links, split to stay under Telegram's message limit
+    lines = [f"{mark} `{name}`\n{detail}" for mark, name, detail in filter(None, results)]
+    pages, page = [], f"📦 **Batch finished:** {batch.done} uploaded, {batch.failed} failed\n"
+    for line in lines:
+        if len(page) + len(line) > 3800:
+            pages.append(page)
+            page = ""
+        page += f"\n{line}"
+    pages.append(page)
+    await msg.edit(pages[0], link_preview=False)
+    for page in pages[1:]: await msg.respond(page, link_preview=False)
+
+def submit_batch(urls, priority, msg):
+    return scheduler.submit(f"batch of {len(urls)}", priority, msg, lambda job: run_batch_job(job, urls, msg))
 
 # --- 11. BOT HANDLERS ---
 @client.on(events.NewMessage(incoming=True))
@@ -532,44 +2888,81 @@ async def handle_new_message(event):
     if event.sender_id != ADMIN_ID: return
 
     if event.file:
-        await event.reply(
-            f"📂 **File Detected:** `{event.file.name or 'video.mp4'}`",
-            buttons=[
-                [Button.inline("🔗 Get Direct Link", data=f"link_{event.id}")],
-                [Button.inline("🛡️ Upload to Cloudflare R2", data=f"r2_{event.id}")]
-            ]
-        )
+        buttons = [
+            [Button.inline("🔗 Get Direct Link", data=f"link_{event.id}")],
+            [Button.inline("🛡️ Upload to Cloudflare R2", data=f"r2_{event.id}")],
+            [Button.inline("📺 Upload as HLS", data=f"hls_{event.id}")]
+        ]
+        if (event.file.name or '').lower().endswith('.txt') or (event.file.mime_type or '').startswith('text/'):
+            buttons.append([Button.inline("📋 Leech URLs in this file", data=f"batch_{event.id}")])
+        await event.reply(f"📂 **File Detected:** `{event.file.name or 'video.mp4'}`", buttons=buttons)
+        return
+
+    if event.text and event.text.strip() == "/queue":
+        await event.reply(scheduler.queue_text(), buttons=scheduler.cancel_buttons())
         return
 
     if event.text and event.text.startswith("http"):
-        async with global_semaphore:
-            raw_text = event.text.strip()
-            url = raw_text.split(" -n ")[0].strip()
-            custom_name = raw_text.split(" -n ")[1].strip() if " -n " in raw_text else None
-            
-            msg = await event.reply("🔗 **Processing URL...**")
-            start_t = time.time()
-            filename = None
-            
-            try:
-                filename = await download_any_url(url, custom_name, msg, start_t)
-                
-                upload_result = await upload_to_r2(filename, msg)
-                if isinstance(upload_result, tuple):
-                    r2_url, code = upload_result
-                else:
-                    r2_url = upload_result
-                    code = "unknown"
+        raw_text = event.text.strip()
+        priority = PRIORITY_URL
+        prio_match = re.search(r'\s-p\s+(\d)\b', raw_text)
+        if prio_match:
+            priority = int(prio_match.group(1))
+            raw_text = (raw_text[:prio_match.start()] + raw_text[prio_match.end():]).strip()
+        urls = parse_urls(raw_text)
+        if len(urls) > 1:
+            msg = await event.reply(f"📦 **Batch of {len(urls)} URLs...**")
+            job = submit_batch(urls, priority, msg)
+            return await msg.edit(f"⏳ **Queued batch** `{job.id}` · {len(urls)} items", buttons=[[Button.inline("❌ Cancel", data=f"cancel_{job.id}")]])
+        url = raw_text.split(" -n ")[0].strip()
+        custom_name = raw_text.split(" -n ")[1].strip() if " -n " in raw_text else None
+        
+        msg = await event.reply("🔗 **Processing URL...**")
+        job = scheduler.submit(custom_name or url, priority, msg, lambda job: run_url_job(job, url, custom_name, msg))
+        await msg.edit(f"⏳ **Queued** `{job.id}`\n🔗 `{url}`", buttons=[[Button.inline("❌ Cancel", data=f"cancel_{job.id}")]])
 
-                await msg.edit(
-                    f"✅ **Leeched & Uploaded to R2!**\n\n🎬 `{os.path.basename(filename)}`\n🔗 `{r2_url}`",
-                    buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]] if code != "unknown" else None
-                )
-            except Exception as e: 
-                await msg.edit(f"❌ Error: {e}")
-            finally:
-                if filename and os.path.exists(filename): os.remove(filename)
-                force_system_ram_purge()
+async def run_url_job(job, url, custom_name, msg, checkpoint=None):
+    filename = None
+    # Dropped however the job ends; only a killed process leaves it behind for resume_checkpoints()
+    checkpoint = checkpoint or checkpoints.open('url', url=url, custom_name=custom_name)
+    
+    try:
+        async with scheduler.stage(job, 'download'):
+            # A playlist turns this job into a batch; a single video's extraction stays cached for its download
+            use_ytdlp = await should_try_yt_dlp(url)
+            entries = await yt_dlp_playlist_entries(url) if use_ytdlp and not checkpoint.data.get('filename') else None
+            if not entries:
+                filename = await download_any_url(url, custom_name, msg, checkpoint, use_ytdlp)
+                checkpoint.update(filename=filename, downloaded=True)
+                content_key = await asyncio.to_thread(file_content_key, filename) if DEDUP_ENABLED else None
+        if entries:
+            # The batch journals itself from here on
+            checkpoint.drop()
+            job.name = f"playlist of {len(entries)}"
+            return await run_batch_job(job, entries, msg)
+        existing = await find_duplicate(content_key)
+        if existing: return await reply_duplicate(msg, existing)
+
+        if await wants_faststart(filename):
+            async with scheduler.stage(job, 'transcode'):
+                await faststart_remux(filename, msg)
+        async with scheduler.stage(job, 'upload'):
+            upload_result = await upload_to_r2(filename, msg, content_keys=[content_key], checkpoint=checkpoint)
+        if isinstance(upload_result, tuple):
+            r2_url, code = upload_result
+        else:
+            r2_url = upload_result
+            code = "unknown"
+
+        await msg.edit(
+            f"✅ **Leeched & Uploaded to R2!**\n\n🎬 `{os.path.basename(filename)}`\n🔗 `{r2_url}`",
+            buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]] if code != "unknown" else None
+        )
+    except Exception as e: 
+        await msg.edit(f"❌ Error: {e}")
+    finally:
+        checkpoint.drop()
+        if filename and os.path.exists(filename): os.remove(filename)
 
 @client.on(events.CallbackQuery)
 async def on_callback(event):
@@ -583,81 +2976,254 @@ async def on_callback(event):
         if not tg_msg or not tg_msg.file:
             return await event.respond("❌ Error: File not found.")
         
-        code = secrets.token_urlsafe(8)
-        link_storage[code] = {'msg': tg_msg, 'timestamp': time.time()}
+        filename = get_unique_filename(clean_double_extension(re.sub(r'[\\/*?:"<>|]', "", tg_msg.file.name or "video.mp4")))
+        code = link_store.put(tg_link_record(tg_msg, filename))
         
         base = os.environ.get("KOYEB_PUBLIC_URL", "").rstrip('/')
         if not base:
             app_name = os.environ.get('KOYEB_APP_NAME')
             base = f"https://{app_name}.koyeb.app" if app_name else "https://your-bot-name.koyeb.app"
             
-        filename = get_unique_filename(clean_double_extension(re.sub(r'[\\/*?:"<>|]', "", tg_msg.file.name or "video.mp4")))
         hotlink = f"{base}/{code}/{quote(filename)}"
         
-        await event.respond(f"🚀 **Direct Download Link:**\n\n`{hotlink}`\n\n💡 *Valid for 24 hours. Paste into IDM for max speed.*")
+        await event.respond(f"🚀 **Direct Download Link:**\n\n`{hotlink}`\n\n💡 *Valid for {LINK_TTL // 3600} hours. Paste into IDM for max speed.*")
         return
 
     if data.startswith("delr2_"):
         code = data.split("_")[1]
-        item = link_storage.get(code)
+        item = r2_refs.get(code)
         if item and 's3_key' in item:
             s3_key = item['s3_key']
             await event.answer("Deleting file from R2...", alert=False)
             try:
-                await asyncio.to_thread(sync_delete_r2_file, s3_key)
+                if 'hls_prefix' in item:
+                    # An HLS upload is the playlist plus every segment under its prefix
+                    keys = [k for k, _ in await asyncio.to_thread(sync_list_r2_keys, item['hls_prefix'])]
+                    await asyncio.to_thread(sync_delete_r2_batch, keys)
+                    for k in keys: r2_index.remove(k)
+                else:
+                    await asyncio.to_thread(sync_delete_r2_file, s3_key)
+                    r2_index.remove(s3_key)
+                content_index.drop_s3_key(s3_key)
+                r2_refs.drop_s3_key(s3_key)
                 await event.edit(f"🗑️ **File Deleted from Cloudflare R2!**\n\nKey: `{s3_key}`")
-                force_system_ram_purge()
             except Exception as e:
                 await event.edit(f"❌ Delete Error: {e}")
         else:
             await event.answer("❌ Reference expired or already deleted.", alert=True)
         return
 
-    if data.startswith("r2_"):
+    if data.startswith("batch_"):
+        msg_id = int(data.split("_")[1])
+        tg_msg = await client.get_messages(event.chat_id, ids=msg_id)
+        if not tg_msg or not tg_msg.file or tg_msg.file.size > 1024 * 1024:
+            return await event.answer("❌ URL lists must be text files under 1 MB.", alert=True)
+        await event.answer("Reading URL list...", alert=False)
+        raw = b"".join([chunk async for chunk in tg_download(tg_msg.media, tg_msg.file.size)])
+        urls = parse_urls(raw.decode('utf-8', 'ignore'))
+        if not urls: return await event.respond("❌ No URLs found in that file.")
+        msg = await event.respond(f"📦 **Batch of {len(urls)} URLs...**")
+        job = submit_batch(urls, PRIORITY_URL, msg)
+        await msg.edit(f"⏳ **Queued batch** `{job.id}` · {len(urls)} items", buttons=[[Button.inline("❌ Cancel", data=f"cancel_{job.id}")]])
+        return
+
+    if data.startswith("cancel_"):
+        job_id = data.split("_", 1)[1]
+        if scheduler.cancel(job_id):
+            await event.answer(f"Cancelling job {job_id}...", alert=False)
+        else:
+            await event.answer("❌ Job already finished.", alert=True)
+        return
+
+    if data.startswith("r2_") or data.startswith("hls_"):
+        as_hls = data.startswith("hls_")
         msg_id = int(data.split("_")[1])
         await event.answer("Processing R2 Upload...", alert=False)
         tg_msg = await client.get_messages(event.chat_id, ids=msg_id)
         
-        async with global_semaphore:
-            raw_filename = re.sub(r'[\\/*?:"<>|]', "", tg_msg.file.name or "video.mp4")
-            filename = get_unique_filename(clean_double_extension(raw_filename))
-            
-            status = await event.respond(f"⬇️ Downloading from Telegram...")
-            start_t = time.time()
-            try:
-                with open(filename, 'wb') as f:
-                    async for chunk in client.iter_download(tg_msg.media, request_size=1048576):
-                        f.write(chunk)
-                        if f.tell() % (10 * 1024 * 1024) == 0: 
-                            await status.edit(get_status_text("TG Down", filename, f.tell(), tg_msg.file.size, start_t))
-                
-                upload_result = await upload_to_r2(filename, status)
-                if isinstance(upload_result, tuple):
-                    r2_url, code = upload_result
-                else:
-                    r2_url = upload_result
-                    code = "unknown"
+        raw_filename = re.sub(r'[\\/*?:"<>|]', "", tg_msg.file.name or "video.mp4")
+        filename = get_unique_filename(clean_double_extension(raw_filename))
+        
+        status = await event.respond(f"⏳ **Queued for R2:** `{filename}`")
+        run = run_tg_hls_job if as_hls else run_tg_r2_job
+        job = scheduler.submit(filename, PRIORITY_TG, status, lambda job: run(job, tg_msg, filename, status))
+        await status.edit(f"⏳ **Queued for R2** `{job.id}`\n🎬 `{filename}`", buttons=[[Button.inline("❌ Cancel", data=f"cancel_{job.id}")]])
 
-                await status.edit(
-                    f"✅ **Cloudflare R2 Complete!**\n\n🎬 `{os.path.basename(filename)}`\n🔗 `{r2_url}`",
-                    buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]] if code != "unknown" else None
-                )
-                
-            except Exception as e: 
-                await status.edit(f"❌ Error: {e}")
-            finally:
-                if os.path.exists(filename): os.remove(filename)
-                force_system_ram_purge()
+async def download_tg_file(tg_msg, filename, status, checkpoint=None):
+    await status.edit(f"⬇️ Downloading from Telegram...")
+    # Continue a checkpointed download from the last offset that is known to be on disk
+    offset = checkpoint.data.get('offset', 0) if checkpoint and os.path.exists(filename) else 0
+    offset = min(offset, os.path.getsize(filename)) if offset else 0
+    buffers = FILE_SINK_BUFFER + TG_DOWNLOAD_WORKERS * TG_CHUNK_SIZE
+    async with governor.lease(buffers, 'tg_download'), progress_hub.track(status, "TG Down", filename, tg_msg.file.size) as progress:
+        progress.add(offset)
+        async with FileSink(filename, offset) as sink:
+            async for chunk in tg_download(tg_msg.media, tg_msg.file.size, offset=offset):
+                await sink.write(chunk)
+                progress.add(len(chunk))
+                if checkpoint: checkpoint.update(throttle=True, offset=sink.written)
+        offset = sink.pos
+    if checkpoint: checkpoint.update(offset=offset, downloaded=True)
+
+async def run_tg_hls_job(job, tg_msg, filename, status):
+    try:
+        async with scheduler.stage(job, 'download'):
+            await download_tg_file(tg_msg, filename, status)
+        # Segmenting and segment uploads overlap, so the job holds both stages at once
+        async with scheduler.stage(job, 'transcode'), scheduler.stage(job, 'upload'):
+            playlist_url, code = await package_hls_to_r2(filename, status)
+        await status.edit(
+            f"✅ **HLS Upload Complete!**\n\n🎬 `{os.path.basename(filename)}`\n📺 `{playlist_url}`",
+            buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]]
+        )
+    except Exception as e:
+        await status.edit(f"❌ Error: {e}")
+    finally:
+        if os.path.exists(filename): os.remove(filename)
+
+async def run_tg_r2_job(job, tg_msg, filename, status, checkpoint=None):
+    checkpoint = checkpoint or checkpoints.open('tg', chat_id=tg_msg.chat_id, msg_id=tg_msg.id, filename=filename)
+    try:
+        tg_key = tg_content_key(tg_msg)
+        existing = await find_duplicate(tg_key)
+        if existing: return await reply_duplicate(status, existing)
+
+        if R2_STREAM_UPLOAD:
+            # Download and upload overlap, so the job holds both stages at once
+            async with scheduler.stage(job, 'download'), scheduler.stage(job, 'upload'):
+                upload_result = await stream_tg_to_r2(tg_msg, filename, status, checkpoint)
+        else:
+            async with scheduler.stage(job, 'download'):
+                if not (checkpoint.data.get('downloaded') and os.path.exists(filename)):
+                    await download_tg_file(tg_msg, filename, status, checkpoint)
+                content_key = await asyncio.to_thread(file_content_key, filename) if DEDUP_ENABLED else None
+            existing = await find_duplicate(content_key)
+            if existing:
+                remember_content([tg_key], existing)
+                return await reply_duplicate(status, existing)
+
+            if await wants_faststart(filename):
+                async with scheduler.stage(job, 'transcode'):
+                    await faststart_remux(filename, status)
+            async with scheduler.stage(job, 'upload'):
+                upload_result = await upload_to_r2(filename, status, content_keys=[tg_key, content_key], checkpoint=checkpoint)
+        if isinstance(upload_result, tuple):
+            r2_url, code = upload_result
+        else:
+            r2_url = upload_result
+            code = "unknown"
+
+        await status.edit(
+            f"✅ **Cloudflare R2 Complete!**\n\n🎬 `{os.path.basename(filename)}`\n🔗 `{r2_url}`",
+            buttons=[[Button.inline("🗑️ Delete from R2", data=f"delr2_{code}")]] if code != "unknown" else None
+        )
+        
+    except Exception as e: 
+        await status.edit(f"❌ Error: {e}")
+    finally:
+        checkpoint.drop()
+        if os.path.exists(filename): os.remove(filename)
+
+async def resume_checkpoints():
+    # Jobs cut short by a redeploy/OOM kill: pick them up where their journal left off
+    for cp in checkpoints.all():
+        name = cp.data.get('filename') or cp.data.get('custom_name') or cp.data.get('url', '?')
+        if cp.data['kind'] == 'batch': name = f"batch of {len(cp.data['urls'])}"
+        try:
+            status = await client.send_message(ADMIN_ID, f"♻️ **Resuming interrupted job**\n🎬 `{name}`")
+            if cp.data['kind'] == 'tg':
+                tg_msg = await client.get_messages(cp.data['chat_id'], ids=cp.data['msg_id'])
+                if not tg_msg or not tg_msg.file: raise FileNotFoundError("Source message is gone")
+                job = scheduler.submit(name, PRIORITY_TG, status, lambda job, m=tg_msg, s=status, c=cp: run_tg_r2_job(job, m, c.data['filename'], s, c))
+            elif cp.data['kind'] == 'batch':
+                job = scheduler.submit(name, cp.data.get('priority', PRIORITY_URL), status, lambda job, s=status, c=cp: run_batch_job(job, c.data['urls'], s, c))
+            else:
+                job = scheduler.submit(name, PRIORITY_URL, status, lambda job, s=status, c=cp: run_url_job(job, c.data['url'], c.data.get('custom_name'), s, c))
+            await status.edit(f"♻️ **Resumed as job** `{job.id}`\n🎬 `{name}`", buttons=[[Button.inline("❌ Cancel", data=f"cancel_{job.id}")]])
+        except Exception as e:
+            cp.drop()
+            try: await client.send_message(ADMIN_ID, f"❌ Could not resume `{name}`: {e}")
+            except Exception: pass
+
+# --- 11b. STREAM WORKER PROCESSES ---
+HOP_HEADERS = {'host', 'connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade', 'proxy-authorization', 'proxy-connection'}
+
+async def control_proxy(request):
+    # Dashboard, bulk jobs and metrics keep their state in the bot process: relay them there
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS}
+    headers['X-Forwarded-For'] = request.remote or ''
+    url = f"http://127.0.0.1:{CONTROL_PORT}{request.path_qs}"
+    try:
+        async with get_http_session().request(request.method, url, headers=headers, data=request.content if request.can_read_body else None,
+                                              allow_redirects=False) as upstream:
+            resp = web.StreamResponse(status=upstream.status, headers={k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS})
+            await resp.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await resp.write(chunk)
+            return resp
+    except aiohttp.ClientConnectionError:
+        return web.Response(status=503, text="Bot process unavailable")
+
+async def fetch_worker_metrics():
+    # A worker that is restarting just drops out of this scrape
+    async def fetch(index):
+        try:
+            async with get_http_session().get(f"http://127.0.0.1:{CONTROL_PORT + 1 + index}/metrics", timeout=aiohttp.ClientTimeout(total=2)) as resp:
+                return await resp.json()
+        except Exception:
+            return None
+    return [m for m in await asyncio.gather(*(fetch(i) for i in range(STREAM_WORKERS))) if m]
+
+async def worker_metrics_handler(request):
+    return web.json_response(worker_metric_samples(STREAM_WORKER_INDEX))
+
+async def stream_worker_main():
+    try: ctypes.CDLL('libc.so.6').prctl(1, 15)  # PR_SET_PDEATHSIG = SIGTERM: exit with the bot process
+    except Exception: pass
+    app = web.Application(middlewares=[metrics_middleware])
+    # Same table and order as the bot process, so '/api/files' never lands on '/{code}/{filename}'
+    app.add_routes([web.RouteDef(r.method, r.path, r.handler if r.handler is stream_handler else control_proxy, r.kwargs) for r in routes])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await client.start(bot_token=BOT_TOKEN)
+    asyncio.create_task(governor.monitor())
+    await web.TCPSite(runner, '0.0.0.0', int(os.environ.get("PORT", 8000)), reuse_port=True).start()
+    # The public /metrics is proxied to the bot process, which collects this one from every worker
+    internal = web.Application()
+    internal.router.add_get('/metrics', worker_metrics_handler)
+    internal_runner = web.AppRunner(internal)
+    await internal_runner.setup()
+    await web.TCPSite(internal_runner, '127.0.0.1', CONTROL_PORT + 1 + int(STREAM_WORKER_INDEX)).start()
+    await client.run_until_disconnected()
+
+async def stream_worker_supervisor(index):
+    # Respawn a worker that exits; each keeps its index, and so its session file
+    while True:
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env={**os.environ, 'STREAM_WORKER_INDEX': str(index)})
+        code = await proc.wait()
+        log.warning("stream worker %s exited with %s; restarting", index, code)
+        await asyncio.sleep(5)
 
 # --- 12. STARTUP ---
 async def main():
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware])
     app.add_routes(routes)
     runner = web.AppRunner(app)
     await runner.setup()
-    await web.TCPSite(runner, '0.0.0.0', int(os.environ.get("PORT", 8000))).start()
+    if MULTI_PROCESS:
+        await web.TCPSite(runner, '127.0.0.1', CONTROL_PORT).start()
+    else:
+        if STREAM_WORKERS: log.warning("STREAM_WORKERS needs LINK_DB_PATH; serving from a single process")
+        await web.TCPSite(runner, '0.0.0.0', int(os.environ.get("PORT", 8000))).start()
     await client.start(bot_token=BOT_TOKEN)
+    asyncio.create_task(link_sweeper())
+    asyncio.create_task(loop_lag_monitor())
+    asyncio.create_task(governor.monitor())
+    await resume_checkpoints()
+    asyncio.create_task(multipart_reaper())
+    if MULTI_PROCESS:
+        for i in range(STREAM_WORKERS): asyncio.create_task(stream_worker_supervisor(i))
     await client.run_until_disconnected()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    asyncio.run(stream_worker_main() if STREAM_WORKER_INDEX else main())
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import time
+import yt_dlp
+
+# Child-process entry point for main.py's yt-dlp jobs, so extraction and
+# postprocessing never compete with the bot's event loop for the GIL.
+# Protocol: one JSON request on stdin, JSON lines back on stdout.
+# Keep this module free of main.py imports: children must not build a Telegram client.
+
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'nocheckcertificate': True,
+    'geo_bypass': True,
+    'overwrites': True,
+    'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+}
+
+def suitable(send, url):
+    # Site extractors only: whether the generic one applies is main.py's cheap HTTP probe
+    return any(ie.suitable(url) for ie in yt_dlp.extractor.gen_extractor_classes() if ie.IE_NAME != 'generic')
+
+def extract(send, url):
+    # Playlists come back as a flat list of entry URLs (main.py turns them into a batch);
+    # a single video is still fully resolved, ready for download()
+    with yt_dlp.YoutubeDL({**YDL_OPTS, 'extract_flat': 'in_playlist'}) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return ydl.sanitize_info(info)
+
+def download(send, info, out_tmpl):
+    last = [0]
+    def hook(d):
+        now = time.time()
+        if d.get('status') == 'downloading' and now - last[0] > 0.5:
+            last[0] = now
+            send({'progress': [d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate') or 0]})
+
+    # Same path as `yt-dlp --load-info-json`: no second extraction round-trip
+    with yt_dlp.YoutubeDL({**YDL_OPTS, 'outtmpl': out_tmpl, 'progress_hooks': [hook]}) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+        return ydl.prepare_filename(info)
+
+def main():
+    # Anything yt-dlp or ffmpeg prints goes to stderr; stdout carries only our protocol
+    out = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+    def send(obj):
+        out.write(json.dumps(obj) + "\n")
+        out.flush()
+
+    request = json.load(sys.stdin)
+    try:
+        send({'ok': globals()[request['func']](send, *request['args'])})
+    except Exception as e:
+        send({'error': f"{type(e).__name__}: {e}"})
+
+if __name__ == '__main__':
+    main()